@@ -1,6 +1,13 @@
-import os, json, time, threading, requests
+import os, io, csv, gzip, json, time, threading, queue, atexit, heapq, itertools, socket, tempfile, uuid
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import click
 from flask import Flask, request, jsonify
-from redis import Redis, ConnectionError, TimeoutError
+from redis import Redis, ConnectionPool, ConnectionError, TimeoutError
+from redis.backoff import NoBackoff
+from redis.retry import Retry
+from botapi import BotAPI
+from metrics import REGISTRY, Counter, Gauge, Histogram
 
 # ===== קונפיג בסיסי =====
 TOKEN = os.getenv("TOKEN")  # Render → Environment: TOKEN=123456:ABC...
@@ -8,7 +15,30 @@ if not TOKEN or ":" not in TOKEN:
     raise RuntimeError("Missing/invalid TOKEN env var. Set TOKEN in Render → Environment.")
 
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "tg-webhook-123456")  # מומלץ להחליף למחרוזת אקראית ארוכה
-API = f"https://api.telegram.org/bot{TOKEN}"
+
+# ===== מטריקות (נחשפות ב-/metrics) =====
+# כל עדכון הוא כמה פעולות dict/bisect תחת נעילה – זניח מול round-trip לרשת.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # אם מוגדר – /metrics דורש Authorization: Bearer <token>
+
+update_latency = Histogram("bot_update_seconds", "Update handling time by update type and command",
+                           labels=("type", "command"))
+update_errors = Counter("bot_update_errors_total", "Updates whose handler raised", labels=("type",))
+api_latency = Histogram("bot_api_seconds", "Bot API call latency", labels=("method",))
+api_requests = Counter("bot_api_requests_total", "Bot API calls by method and HTTP status (error = no response)",
+                       labels=("method", "status"))
+redis_latency = Histogram("redis_call_seconds", "redis_call latency including retries", labels=("outcome",))
+redis_roundtrips = Counter("redis_roundtrips_total", "Attempts made by redis_call (one command or pipeline each)")
+redis_rejected = Counter("redis_rejected_total", "redis_call calls skipped because the breaker was open")
+dotall_duration = Histogram("dotall_job_seconds", "/dotall job duration",
+                            buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600))
+dotall_mentions = Counter("dotall_mentions_total", "Mentions sent by /dotall")
+dotall_messages = Counter("dotall_messages_total", "Messages sent by /dotall")
+
+def _observe_api(method: str, status, seconds: float):
+    api_latency.observe(seconds, method)
+    api_requests.inc(method, str(status))
+
+api = BotAPI(TOKEN, observer=_observe_api)  # Session משותף עם keep-alive – ראו botapi.py (TG_POOL_SIZE / TG_*_TIMEOUT)
 
 # ---- Owner (מנהל־על) ----
 OWNER_ID = os.getenv("OWNER_ID")
@@ -23,63 +53,147 @@ REDIS_URL = os.getenv("REDIS_URL")  # Render → Environment: REDIS_URL=rediss:/
 if not REDIS_URL:
     raise RuntimeError("Missing REDIS_URL env var.")
 
+REDIS_POOL_SIZE = int(os.getenv("REDIS_POOL_SIZE", "32"))
+REDIS_BREAKER_THRESHOLD = int(os.getenv("REDIS_BREAKER_THRESHOLD", "5"))   # כשלים רצופים עד שהמפסק נפתח
+REDIS_BREAKER_COOLDOWN = float(os.getenv("REDIS_BREAKER_COOLDOWN", "10"))  # שניות עד ניסיון חוזר (half-open)
+
+# pool אחד לכל התהליך: חיבור שנפל נזרק ונפתח מחדש בעצלות, בלי לבנות קליינט חדש
+# לא להעביר ssl=True כשמשתמשים ב-rediss://
+pool = ConnectionPool.from_url(
+    REDIS_URL,
+    decode_responses=True,
+    max_connections=REDIS_POOL_SIZE,
+    socket_connect_timeout=5,  # התחברות
+    socket_timeout=5,          # קריאה/כתיבה
+    retry=Retry(NoBackoff(), 0),  # את הניסיון החוזר עושה redis_call, והמפסק מחליט מתי להפסיק
+    health_check_interval=30,  # בדיקת חיות קבועה
+)
+
 def new_client():
-    # לא להעביר ssl=True כשמשתמשים ב-rediss://
-    return Redis.from_url(
-        REDIS_URL,
-        decode_responses=True,
-        socket_connect_timeout=5,  # התחברות
-        socket_timeout=5,          # קריאה/כתיבה
-        retry_on_timeout=True,
-        health_check_interval=30,  # בדיקת חיות קבועה
-    )
+    return Redis(connection_pool=pool)
 
 r = new_client()
 
-def redis_call(fn, *, retries=2, default=None):
+class CircuitBreaker:
+    """
+    closed → open אחרי threshold כשלי חיבור רצופים; ב-open כל קריאה נכשלת מיד (בלי המתנה ל-timeout).
+    אחרי cooldown עובר ל-half_open ומאפשר קריאת ניסיון אחת: הצלחה סוגרת, כשל פותח מחדש.
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        self.on_close = []
+        self.stats = {"opens": 0, "rejected": 0}
+
+    def blocked(self) -> bool:
+        return self.state == self.OPEN and time.monotonic() - self.opened_at < self.cooldown
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.stats["rejected"] += 1
+            return False
+
+    def success(self):
+        if self.state == self.CLOSED and not self.failures:
+            return
+        with self._lock:
+            reopened = self.state != self.CLOSED
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+        if reopened:
+            print("✅ Redis breaker closed")
+            for fn in self.on_close:
+                fn()
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.threshold):
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.stats["opens"] += 1
+                print("❌ Redis breaker open")
+
+    def reset(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats, state=self.state, failures=self.failures)
+
+breaker = CircuitBreaker(REDIS_BREAKER_THRESHOLD, REDIS_BREAKER_COOLDOWN)
+
+COMMAND_ERROR = object()  # ערך on_error: Redis ענה בשגיאה (WRONGTYPE, שגיאת סקריפט...) – ניסיון חוזר לא יעזור
+
+def redis_call(fn, *, retries=1, default=None, on_error=None):
     """
-    מריץ קריאת Redis עם עד 2 רטרייז. אם יש כשל חיבור/טיים־אאוט,
-    נפתח קליינט חדש ומנסים שוב. מחזיר default אם לא הצליח.
+    מריץ קריאת Redis דרך ה-circuit breaker. כשל חיבור/טיים־אאוט מנוסה שוב מיד
+    (ה-pool נותן חיבור אחר), בלי sleep. מחזיר default אם לא הצליח או שהמפסק פתוח;
+    אם Redis ענה בשגיאת פקודה מחזיר on_error (ברירת מחדל: default), כדי שהקורא יבדיל ביניהם.
     """
+    if not breaker.allow():
+        redis_rejected.inc()
+        return default
     last_exc = None
-    for i in range(retries + 1):
+    started = time.perf_counter()
+    for _ in range(retries + 1):
+        redis_roundtrips.inc()
         try:
-            return fn()
+            res = fn()
+            breaker.success()
+            redis_latency.observe(time.perf_counter() - started, "ok")
+            return res
         except (ConnectionError, TimeoutError) as e:
             last_exc = e
-            try:
-                globals()['r'] = new_client()
-            except Exception as e2:
-                last_exc = e2
-            time.sleep(0.2 * (i + 1))
         except Exception as e:
+            breaker.success()  # Redis ענה – הבעיה בפקודה עצמה
+            redis_latency.observe(time.perf_counter() - started, "error")
             print("❌ Redis op failed:", repr(e))
-            return default
+            return default if on_error is None else on_error
+    breaker.failure()
+    redis_latency.observe(time.perf_counter() - started, "connection_error")
     print("❌ Redis connection failed:", repr(last_exc))
     return default
 
-# דיאגנוסטיקה בהעלאה
-try:
-    redis_call(lambda: r.ping())
-    print("✅ Redis connected")
-except Exception as e:
-    print("❌ Redis ping failed at startup:", e)
+# threads שרצים לאורך חיי ה-worker. לא מופעלים ב-import אלא ב-start_background()
+# (create_app), כדי שה-import יהיה מהיר ושיעלו בתהליך הנכון אחרי fork של gunicorn
+background_tasks = []
 
 # תצורת שליחה של /dotall
-MENTION_CHUNK = int(os.getenv("MENTION_CHUNK", "100"))
-MENTION_DELAY = float(os.getenv("MENTION_DELAY", "0.15"))
+MENTION_CHUNK = int(os.getenv("MENTION_CHUNK", "100"))  # קצב השליחה עצמו – ראו DOTALL_* ליד המתזמן
 
 HELP_TEXT = (
     "👋 Hi! I'm a group management bot.\n\n"
     "Group commands:\n"
     "• /count — Show how many users are stored (excludes blacklist).\n"
-    "• /export — (Admins) Print a preview of stored users.\n"
+    "• /export [csv|jsonl] [gz] — (Admins) Send all stored users as a file.\n"
     "• /bl_add <id> — (Admins) Add a user to the blacklist. Can also reply to user's message.\n"
     "• /bl_remove <id> — (Admins) Remove a user from the blacklist (or reply).\n"
-    "• /bl_list — (Admins) Show the current blacklist (truncated).\n"
+    "• /bl_list [csv|jsonl] [gz] — (Admins) Send the blacklist as a file.\n"
     "• /all_users — Show who is allowed to run /dotall (admins only vs everyone).\n"
     "• /all_users on|off — (Admins) Allow everyone to run /dotall or restrict it to admins only.\n"
-    "• /dotall — Send mass dot-mentions for all stored users in batches.\n\n"
+    "• /dotall — Send mass dot-mentions for all stored users in batches.\n"
+    "• /dotall_cancel — Stop a running /dotall (admins or whoever started it).\n\n"
     "Notes:\n"
     "• The bot auto-saves anyone who writes or joins; removes users when they leave.\n"
     "• Users in the blacklist are not saved and won't be mentioned.\n"
@@ -88,9 +202,13 @@ HELP_TEXT = (
 app = Flask(__name__)
 
 # ---------- Redis keys helpers ----------
-def _k_members(chat_id: int) -> str:   return f"chat:{chat_id}:members"     # Hash: uid -> JSON
-def _k_blacklist(chat_id: int) -> str: return f"chat:{chat_id}:blacklist"   # Hash: uid -> JSON
+def _k_members(chat_id: int) -> str:   return f"chat:{chat_id}:members"     # Hash: uid -> פרופיל (JSON או packed)
+def _k_blacklist(chat_id: int) -> str: return f"chat:{chat_id}:blacklist"   # Hash: uid -> פרופיל (JSON או packed)
 def _k_settings(chat_id: int) -> str:  return f"chat:{chat_id}:settings"    # Hash: key -> str
+def _k_admins(chat_id: int) -> str:    return f"chat:{chat_id}:admins"      # Set: uid של מנהלים (עם EXPIRE)
+def _k_bots(chat_id: int) -> str:      return f"chat:{chat_id}:bots"        # Set: uid שלא מתייגים (username שנגמר ב-bot)
+def _k_ids(chat_id: int) -> str:       return f"chat:{chat_id}:ids"         # Set: uid בלבד – מסלול התיוג
+_K_IDS_READY = "members:ids_ready"                                           # Set: צ'אטים ש-chat:{id}:ids שלם אצלם
 
 # ---------- Bot API עזר ----------
 def send_message(
@@ -106,21 +224,142 @@ def send_message(
     if parse_mode: payload["parse_mode"] = parse_mode
     if reply_to_message_id: payload["reply_to_message_id"] = reply_to_message_id
     if disable_web_page_preview: payload["disable_web_page_preview"] = True
-    rsp = requests.post(f"{API}/sendMessage", json=payload, timeout=20)
+    scheduler.debit_global()  # גם תשובות רגילות נספרות בתקציב הגלובלי של /dotall
+    try:
+        rsp = api.post("sendMessage", payload)
+    except Exception as e:
+        print("send_message error:", e)
+        return
     if not rsp.ok:
         print("send_message fail:", rsp.status_code, rsp.text)
+        return
+    return rsp.json().get("result")  # ה-Message שנשלח (למשל message_id לעריכה)
+
+def edit_message(chat_id: int, message_id: int, text: str):
+    try:
+        rsp = api.post("editMessageText", {"chat_id": chat_id, "message_id": message_id, "text": text})
+    except Exception as e:
+        print("edit_message error:", e)
+        return
+    if not rsp.ok:
+        print("edit_message fail:", rsp.status_code, rsp.text)
+
+# ---------- Cache מנהלים (LRU בתהליך + Redis משותף) ----------
+ADMIN_STATUSES = {"creator", "administrator"}
+ADMIN_CACHE_TTL = int(os.getenv("ADMIN_CACHE_TTL", "600"))    # שכבת Redis, משותפת לכל ה-workers
+ADMIN_LOCAL_TTL = int(os.getenv("ADMIN_LOCAL_TTL", "60"))     # LRU מקומי – קצר: גיבוי לביטול ב-pub/sub שהוחמץ (או CACHE_PUBSUB=0)
+ADMIN_LOCAL_SIZE = int(os.getenv("ADMIN_LOCAL_SIZE", "1000")) # מספר צ'אטים מקסימלי ב-LRU
+
+class AdminCache:
+    """
+    LRU לפי chat_id -> frozenset של מזהי מנהלים, עם TTL לכל רשומה.
+    שומרים את כל רשימת המנהלים של הצ'אט, כך ששאלה על כל משתמש באותו צ'אט היא hit.
+    """
+    def __init__(self, size: int, ttl: int):
+        self.size = size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"local_hits": 0, "redis_hits": 0, "misses": 0, "invalidations": 0}
+
+    def count(self, name: str):
+        with self._lock:
+            self.stats[name] += 1
+
+    def get(self, chat_id: int):
+        with self._lock:
+            item = self._data.get(chat_id)
+            if item is None:
+                return None
+            expires_at, admins = item
+            if expires_at < time.monotonic():
+                del self._data[chat_id]
+                return None
+            self._data.move_to_end(chat_id)
+            self.stats["local_hits"] += 1
+            return admins
+
+    def put(self, chat_id: int, admins):
+        with self._lock:
+            self._data[chat_id] = (time.monotonic() + self.ttl, frozenset(admins))
+            self._data.move_to_end(chat_id)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def pop(self, chat_id: int):
+        with self._lock:
+            self._data.pop(chat_id, None)
+            self.stats["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats, size=len(self._data))
+
+admin_cache = AdminCache(ADMIN_LOCAL_SIZE, ADMIN_LOCAL_TTL)
+
+def fetch_chat_admins(chat_id: int):
+    """
+    getChatAdministrators – קריאה אחת שממלאת את ה-cache לכל מנהלי הצ'אט.
+    מחזיר set של מזהים, או None אם טלגרם לא ענה (למשל הבוט לא בקבוצה).
+    """
+    try:
+        rsp = api.get("getChatAdministrators", {"chat_id": chat_id}, timeout=10)
+        if rsp.ok:
+            return {m["user"]["id"] for m in rsp.json().get("result", []) if m.get("user", {}).get("id")}
+        print("getChatAdministrators fail:", rsp.status_code, rsp.text)
+    except Exception as e:
+        print("getChatAdministrators error:", e)
+    return None
+
+def get_chat_admins(chat_id: int):
+    admins = admin_cache.get(chat_id)
+    if admins is not None:
+        return admins
+
+    # "0" הוא סמן – כך גם רשימה ריקה נשמרת כ-key קיים
+    cached = redis_call(lambda: r.smembers(_k_admins(chat_id)), default=None)
+    if cached:
+        admins = {int(x) for x in cached if x != "0"}
+        admin_cache.count("redis_hits")
+        admin_cache.put(chat_id, admins)
+        return admins
+
+    admin_cache.count("misses")
+    admins = fetch_chat_admins(chat_id)
+    if admins is None:
+        return None
+    def _fill():
+        pipe = r.pipeline()
+        pipe.delete(_k_admins(chat_id))
+        pipe.sadd(_k_admins(chat_id), "0", *[str(a) for a in admins])
+        pipe.expire(_k_admins(chat_id), ADMIN_CACHE_TTL)
+        pipe.execute()
+    redis_call(_fill)
+    admin_cache.put(chat_id, admins)
+    return admins
+
+def invalidate_admins(chat_id: int):
+    admin_cache.pop(chat_id)
+    redis_call(lambda: r.delete(_k_admins(chat_id)))
+    publish_invalidation("admins", chat_id)  # שאר ה-workers מוחקים את ה-LRU שלהם
 
 def is_admin(chat_id: int, user_id: int) -> bool:
     # הבעלים נחשב תמיד כאדמין
     if OWNER_ID and user_id == OWNER_ID:
         return True
+    admins = get_chat_admins(chat_id)
+    if admins is not None:
+        return user_id in admins
+    # fallback: בדיקה בודדת בלי cache
     try:
-        rsp = requests.get(f"{API}/getChatMember",
-                           params={"chat_id": chat_id, "user_id": user_id},
-                           timeout=10)
+        rsp = api.get("getChatMember", {"chat_id": chat_id, "user_id": user_id}, timeout=10)
         if rsp.ok:
             status = rsp.json().get("result", {}).get("status")
-            return status in {"creator", "administrator"}
+            return status in ADMIN_STATUSES
     except Exception as e:
         print("is_admin error:", e)
     return False
@@ -140,41 +379,387 @@ def resolve_target_user(msg, arg: str | None):
 def is_blacklisted(chat_id: int, user_id: int) -> bool:
     return bool(redis_call(lambda: r.hexists(_k_blacklist(chat_id), str(user_id)), default=False))
 
-def add_user(chat_id: int, user: dict):
-    if not user or "id" not in user:
-        return
-    if user.get("is_bot"):  # ✅ לא שומרים בוטים
-        return
-    if is_blacklisted(chat_id, user["id"]):
-        return
-    uid = str(user["id"])
-    slim = {
+# ---------- פורמט שמירה של פרופיל חבר ----------
+class JsonCodec:
+    """הפורמט המקורי: JSON מלא עם שמות שדות ו-id."""
+    def encode(self, slim: dict) -> str:
+        return json.dumps(slim, ensure_ascii=False)
+
+    def decode(self, uid: str, raw: str) -> dict:
+        return json.loads(raw)
+
+class PackedCodec:
+    """
+    פורמט קומפקטי: \\x01first\\x1flast\\x1fusername\\x1fadded_at – בלי שמות שדות ובלי id
+    (הוא כבר ה-field ב-Hash). הבייט הראשון מבדיל אותו מ-JSON, כך ששני הפורמטים חיים יחד ב-Hash.
+    """
+    PREFIX = "\x01"
+    SEP = "\x1f"
+
+    def _clean(self, v) -> str:
+        return (v or "").replace(self.SEP, " ").replace(self.PREFIX, " ")
+
+    def encode(self, slim: dict) -> str:
+        return self.PREFIX + self.SEP.join((self._clean(slim.get("first_name")), self._clean(slim.get("last_name")),
+                                            self._clean(slim.get("username")), str(slim.get("added_at") or 0)))
+
+    def decode(self, uid: str, raw: str) -> dict:
+        first, last, username, added_at = raw[1:].split(self.SEP, 3)
+        return {"id": int(uid), "first_name": first or None, "last_name": last or None,
+                "username": username or None, "added_at": int(added_at or 0)}
+
+MEMBER_CODECS = {"json": JsonCodec(), "packed": PackedCodec()}
+MEMBER_FORMAT = os.getenv("MEMBER_FORMAT", "json")  # json | packed – פורמט לכתיבות חדשות; קריאה מזהה לבד
+member_codec = MEMBER_CODECS[MEMBER_FORMAT]
+
+def decode_member(uid: str, raw: str) -> dict:
+    fmt = "packed" if raw.startswith(PackedCodec.PREFIX) else "json"
+    return MEMBER_CODECS[fmt].decode(uid, raw)
+
+# upsert אטומי בצד השרת: בדיקת blacklist + כתיבה רק אם הפרופיל השתנה, לכמה משתמשים בקריאה אחת.
+# כשהפרופיל נכתב מתעדכן גם אינדקס הבוטים (username שנגמר ב-bot); סט המזהים מתעדכן תמיד.
+# הערך הקיים יכול להיות JSON או packed (ראו PackedCodec).
+# KEYS[1]=members KEYS[2]=blacklist KEYS[3]=bots KEYS[4]=ids
+# ARGV: חמישיות uid, first_name, last_name, username, ערך מקודד מוכן
+_UPSERT_MEMBERS_LUA = """
+local function f(v)
+  if v == nil or v == cjson.null then return '' end
+  return tostring(v)
+end
+local function profile(cur)
+  if string.sub(cur, 1, 1) == '\\1' then
+    local t = {}
+    for part in string.gmatch(string.sub(cur, 2) .. '\\31', '([^\\31]*)\\31') do t[#t + 1] = part end
+    return t[1], t[2], t[3]
+  end
+  local ok, old = pcall(cjson.decode, cur)
+  if ok and type(old) == 'table' then
+    return f(old.first_name), f(old.last_name), f(old.username)
+  end
+end
+local written = 0
+for i = 1, #ARGV, 5 do
+  local uid = ARGV[i]
+  if redis.call('HEXISTS', KEYS[2], uid) == 0 then
+    redis.call('SADD', KEYS[4], uid)
+    local cur = redis.call('HGET', KEYS[1], uid)
+    local same = false
+    if cur then
+      local first, last, username = profile(cur)
+      same = first == ARGV[i+1] and last == ARGV[i+2] and username == ARGV[i+3]
+    end
+    if not same then
+      redis.call('HSET', KEYS[1], uid, ARGV[i+4])
+      if string.sub(string.lower(ARGV[i+3]), -3) == 'bot' then
+        redis.call('SADD', KEYS[3], uid)
+      else
+        redis.call('SREM', KEYS[3], uid)
+      end
+      written = written + 1
+    end
+  end
+end
+return written
+"""
+_upsert_members = r.register_script(_UPSERT_MEMBERS_LUA)
+
+# page אחד של /dotall: סריקה וסינון מול אינדקס הבוטים בצד השרת – חוזרים רק מזהים.
+# המקור הוא chat:{id}:ids (SSCAN) אם הוא שלם, אחרת ה-Hash של החברים (HSCAN).
+# KEYS[1]=ids/members KEYS[2]=bots ; ARGV[1]=cursor ARGV[2]=count ARGV[3]=ids|members
+# מחזיר {next_cursor, uid...}
+_DOTALL_PAGE_LUA = """
+local set = ARGV[3] == 'ids'
+local page = redis.call(set and 'SSCAN' or 'HSCAN', KEYS[1], ARGV[1], 'COUNT', ARGV[2])
+local out = {page[1]}
+local items = page[2]
+for i = 1, #items, set and 1 or 2 do
+  if redis.call('SISMEMBER', KEYS[2], items[i]) == 0 then
+    out[#out + 1] = items[i]
+  end
+end
+return out
+"""
+_dotall_page = r.register_script(_DOTALL_PAGE_LUA)
+
+def _slim_user(user: dict) -> dict:
+    return {
         "id": user["id"],
         "first_name": user.get("first_name"),
         "last_name": user.get("last_name"),
         "username": user.get("username"),
         "added_at": int(time.time())
     }
-    redis_call(lambda: r.hset(_k_members(chat_id), uid, json.dumps(slim, ensure_ascii=False)))
+
+def _upsert_args(users: list) -> list:
+    args = []
+    for user in users:
+        if not user or "id" not in user:
+            continue
+        if user.get("is_bot"):  # ✅ לא שומרים בוטים
+            continue
+        slim = _slim_user(user)
+        args += [str(user["id"]), slim["first_name"] or "", slim["last_name"] or "", slim["username"] or "",
+                 member_codec.encode(slim)]
+    return args
+
+def upsert_members(chat_id: int, users: list) -> int:
+    """
+    שומר כמה משתמשים ב-round-trip אחד (EVALSHA). בוטים מסוננים כאן, blacklist בצד השרת,
+    ופרופיל שלא השתנה לא נכתב מחדש (added_at נשאר מהפעם הראשונה).
+    מחזיר כמה נכתבו, או None אם Redis לא זמין.
+    """
+    args = _upsert_args(users)
+    if not args:
+        return 0
+    keys = [_k_members(chat_id), _k_blacklist(chat_id), _k_bots(chat_id), _k_ids(chat_id)]
+    written = redis_call(lambda: _upsert_members(keys=keys, args=args, client=r), default=None)
+    return None if written is None else int(written)
+
+def _write_member_ops(ops: dict):
+    """
+    כותב אוסף שינויים {(chat_id, uid): user או None} ב-pipeline אחד לכל הצ'אטים.
+    None = הסרה (HDEL); משתמש = upsert דרך אותו סקריפט Lua.
+    מחזיר True אם נכתב, False אם Redis לא זמין (שווה לנסות שוב), או COMMAND_ERROR
+    אם Redis ענה בשגיאה – batch כזה לא ייכתב גם בניסיון חוזר.
+    """
+    adds, dels = {}, {}
+    for (chat_id, uid), user in ops.items():
+        if user is None:
+            dels.setdefault(chat_id, []).append(str(uid))
+        else:
+            adds.setdefault(chat_id, []).append(user)
+    if not dels and len(adds) == 1:
+        # מקרה הכתיבה הישירה (עדכון בודד): EVALSHA אחד, בלי SCRIPT EXISTS של pipeline
+        (chat_id, users), = adds.items()
+        args = _upsert_args(users)
+        if not args:
+            return True
+        keys = [_k_members(chat_id), _k_blacklist(chat_id), _k_bots(chat_id), _k_ids(chat_id)]
+        res = redis_call(lambda: _upsert_members(keys=keys, args=args, client=r), default=None,
+                         on_error=COMMAND_ERROR)
+        return res if res is COMMAND_ERROR else res is not None
+    def _tx():
+        pipe = r.pipeline(transaction=False)
+        for chat_id, uids in dels.items():
+            pipe.hdel(_k_members(chat_id), *uids)
+            pipe.srem(_k_bots(chat_id), *uids)
+            pipe.srem(_k_ids(chat_id), *uids)
+        for chat_id, users in adds.items():
+            args = _upsert_args(users)
+            if args:
+                _upsert_members(keys=[_k_members(chat_id), _k_blacklist(chat_id), _k_bots(chat_id),
+                                      _k_ids(chat_id)], args=args, client=pipe)
+        pipe.execute()
+        return True
+    return redis_call(_tx, default=False, on_error=COMMAND_ERROR)
+
+# ---------- Journal לכתיבות חברים בזמן ש-Redis לא זמין ----------
+REDIS_JOURNAL_MAX = int(os.getenv("REDIS_JOURNAL_MAX", "20000"))  # מקסימום שינויים ממתינים; הישנים נזרקים
+
+class MemberJournal:
+    """
+    תור חסום של batches שלא נכתבו, לפי סדר הגעה. כל עוד יש בו משהו, גם כתיבות חדשות
+    נכנסות לסופו – כך שה-replay שומר על הסדר. ה-replay רץ ב-thread משלו: כשהמפסק
+    נסגר, ובבדיקה תקופתית כל עוד יש שינויים ממתינים.
+    """
+    def __init__(self, max_ops: int):
+        self.max_ops = max_ops
+        self._q = deque()
+        self._ops = 0
+        self._lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self.stats = {"journaled": 0, "replayed": 0, "dropped": 0, "rejected": 0, "last_replay_lag_s": 0.0}
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._q)
+
+    def append(self, ops: dict):
+        with self._lock:
+            self._q.append((time.time(), ops))
+            self._ops += len(ops)
+            self.stats["journaled"] += len(ops)
+            while self._ops > self.max_ops and len(self._q) > 1:
+                _, old = self._q.popleft()
+                self._ops -= len(old)
+                self.stats["dropped"] += len(old)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def kick(self):
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(2.0)
+            self._wake.clear()
+            if self._q and not breaker.blocked():
+                self.replay()
+
+    def replay(self):
+        with self._replay_lock:
+            while True:
+                with self._lock:
+                    if not self._q:
+                        return
+                    ts, ops = self._q[0]
+                res = _write_member_ops(ops)
+                if res is False:
+                    return  # Redis עדיין לא זמין – ננסה שוב
+                with self._lock:
+                    self._q.popleft()
+                    self._ops -= len(ops)
+                    if res is COMMAND_ERROR:
+                        # Redis דחה את ה-batch – זורקים אותו כדי שלא יחסום את כל הכתיבות שאחריו
+                        self.stats["rejected"] += len(ops)
+                        print(f"❌ journal: dropping {len(ops)} member ops rejected by Redis")
+                    else:
+                        self.stats["replayed"] += len(ops)
+                        self.stats["last_replay_lag_s"] = round(time.time() - ts, 3)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            oldest = round(time.time() - self._q[0][0], 3) if self._q else 0.0
+            return dict(self.stats, pending_ops=self._ops, batches=len(self._q), oldest_age_s=oldest)
+
+journal = MemberJournal(REDIS_JOURNAL_MAX)
+breaker.on_close.append(journal.kick)
+
+def apply_member_ops(ops: dict):
+    """
+    כתיבת שינויי חברות; אם Redis לא זמין (או שיש journal ממתין) – נשמר ב-journal ומחזיר False.
+    רק כשל חיבור נכנס ל-journal: אם Redis דחה את הפקודה מחזיר COMMAND_ERROR והשינויים נזרקים.
+    """
+    if journal.pending or breaker.blocked():
+        journal.append(ops)
+        journal.kick()
+        return False
+    res = _write_member_ops(ops)
+    if res is True:
+        return True
+    if res is COMMAND_ERROR:
+        # שגיאת פקודה (למשל WRONGTYPE על המפתח) – ניסיון חוזר לא יעזור, ולא חוסמים את ה-journal
+        print(f"❌ member write rejected by Redis, dropping {len(ops)} ops")
+        return res
+    journal.append(ops)
+    return False
+
+# ---------- Write-behind לחברי קבוצה ----------
+MEMBER_FLUSH_INTERVAL = float(os.getenv("MEMBER_FLUSH_INTERVAL", "2"))  # שניות; 0 = כתיבה ישירה בלי buffer
+MEMBER_FLUSH_MAX = int(os.getenv("MEMBER_FLUSH_MAX", "500"))            # flush מוקדם כשמצטברים כך שינויים
+
+class MemberBuffer:
+    """
+    מאחד עדכוני חברות לפי (chat_id, uid) וכותב אותם ב-batch כל MEMBER_FLUSH_INTERVAL שניות
+    או כשמגיעים ל-MEMBER_FLUSH_MAX. לכל מפתח נשמר האירוע האחרון בחלון (יצא וחזר = חבר),
+    ו-flush רץ תחת נעילה אחת כדי ששני flush-ים לא יכתבו בסדר הפוך.
+    """
+    def __init__(self, interval: float, max_size: int):
+        self.interval = interval
+        self.max_size = max_size
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self.stats = {"queued": 0, "coalesced": 0, "flushes": 0, "written": 0, "journaled": 0, "rejected": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval > 0
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def _put(self, key, user):
+        self._ensure_thread()
+        with self._lock:
+            self.stats["queued"] += 1
+            if key in self._pending:
+                self.stats["coalesced"] += 1
+            self._pending[key] = user  # האירוע האחרון קובע: הסרה דורסת הוספה, והצטרפות מחדש דורסת הסרה
+            full = len(self._pending) >= self.max_size
+        if full:
+            self._wake.set()
+
+    def add(self, chat_id: int, user: dict):
+        self._put((chat_id, user["id"]), user)
+
+    def remove(self, chat_id: int, user_id: int):
+        self._put((chat_id, user_id), None)
+
+    def discard(self, chat_id: int, user_id: int):
+        with self._lock:
+            self._pending.pop((chat_id, user_id), None)
+
+    def flush(self, chat_id: int | None = None):
+        with self._flush_lock:
+            with self._lock:
+                if chat_id is None:
+                    ops, self._pending = self._pending, {}
+                else:
+                    ops = {k: v for k, v in self._pending.items() if k[0] == chat_id}
+                    for k in ops:
+                        del self._pending[k]
+            if not ops:
+                return
+            res = apply_member_ops(ops)  # כשל חיבור → השינויים עוברים ל-journal וייכתבו ב-replay
+            with self._lock:
+                self.stats["flushes"] += 1
+                key = "written" if res is True else "rejected" if res is COMMAND_ERROR else "journaled"
+                self.stats[key] += len(ops)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats, pending=len(self._pending))
+
+member_buffer = MemberBuffer(MEMBER_FLUSH_INTERVAL, MEMBER_FLUSH_MAX)
+atexit.register(member_buffer.flush)
+
+def save_members(chat_id: int, users: list):
+    if not member_buffer.enabled:
+        ops = {(chat_id, u["id"]): u for u in users if u and "id" in u and not u.get("is_bot")}
+        if ops:
+            apply_member_ops(ops)
+        return
+    for user in users:
+        if user and "id" in user and not user.get("is_bot"):
+            member_buffer.add(chat_id, user)
+
+def add_user(chat_id: int, user: dict):
+    save_members(chat_id, [user])
 
 def remove_user(chat_id: int, user_id: int):
-    redis_call(lambda: r.hdel(_k_members(chat_id), str(user_id)))
+    if member_buffer.enabled:
+        member_buffer.remove(chat_id, user_id)
+        return
+    apply_member_ops({(chat_id, user_id): None})
 
 def blacklist_add(chat_id: int, user: dict) -> bool:
     if not user or "id" not in user:
         return False
     uid = str(user["id"])
-    slim = {
-        "id": user["id"],
-        "first_name": user.get("first_name"),
-        "last_name": user.get("last_name"),
-        "username": user.get("username"),
-        "added_at": int(time.time())
-    }
+    slim = _slim_user(user)
+    member_buffer.discard(chat_id, user["id"])
     def _tx():
         pipe = r.pipeline()
-        pipe.hset(_k_blacklist(chat_id), uid, json.dumps(slim, ensure_ascii=False))
+        pipe.hset(_k_blacklist(chat_id), uid, member_codec.encode(slim))
         pipe.hdel(_k_members(chat_id), uid)
+        pipe.srem(_k_bots(chat_id), uid)
+        pipe.srem(_k_ids(chat_id), uid)
         pipe.execute()
         return True
     return bool(redis_call(_tx, default=False))
@@ -182,35 +767,137 @@ def blacklist_add(chat_id: int, user: dict) -> bool:
 def blacklist_remove(chat_id: int, user_id: int) -> bool:
     return bool(redis_call(lambda: r.hdel(_k_blacklist(chat_id), str(user_id)) == 1, default=False))
 
-def list_members_ids(chat_id: int):
-    ids = redis_call(lambda: r.hkeys(_k_members(chat_id)), default=[])
-    return [int(x) for x in ids]
+SCAN_COUNT = int(os.getenv("SCAN_COUNT", "500"))  # רמז COUNT ל-HSCAN: גודל page בקירוב
 
-def count_users(chat_id: int) -> int:
-    return int(redis_call(lambda: r.hlen(_k_members(chat_id)), default=0) or 0)
+def iter_hash(key: str, count: int = SCAN_COUNT):
+    """
+    מעבר על Hash ב-HSCAN, page אחרי page – בלי למשוך את כולו לזיכרון ובלי לחסום את Redis.
+    אם קריאה נכשלת באמצע זורק ConnectionError – מעבר חלקי לא ייראה כמו Hash שלם.
+    """
+    cursor = 0
+    while True:
+        page = redis_call(lambda: r.hscan(key, cursor, count=count), default=None)
+        if page is None:
+            raise ConnectionError(f"HSCAN {key} failed at cursor {cursor}")
+        cursor, items = page
+        yield from items.items()
+        if not cursor:
+            return
 
-def export_users(chat_id: int):
-    vals = redis_call(lambda: r.hvals(_k_members(chat_id)), default=[])
-    out = []
-    for v in vals:
+def _iter_profiles(key: str):
+    for uid, v in iter_hash(key):
         try:
-            out.append(json.loads(v))
+            yield decode_member(uid, v)
         except Exception:
             pass
-    return out
 
-def list_blacklist(chat_id: int):
-    vals = redis_call(lambda: r.hvals(_k_blacklist(chat_id)), default=[])
-    out = []
-    for v in vals:
+def count_users(chat_id: int) -> int:
+    member_buffer.flush(chat_id)  # קריאות צריכות לראות גם שינויים שעוד ב-buffer
+    return int(redis_call(lambda: r.hlen(_k_members(chat_id)), default=0) or 0)
+
+def iter_members(chat_id: int):
+    member_buffer.flush(chat_id)
+    return _iter_profiles(_k_members(chat_id))
+
+def iter_blacklist(chat_id: int):
+    return _iter_profiles(_k_blacklist(chat_id))
+
+# ---------- Cache הגדרות לכל צ'אט + ביטול בין workers דרך pub/sub ----------
+SETTINGS_TTL = float(os.getenv("SETTINGS_TTL", "300"))   # רשת ביטחון אם הודעת ביטול לא הגיעה
+CACHE_PUBSUB = os.getenv("CACHE_PUBSUB", "1") == "1"
+INVALIDATE_CHANNEL = "cache:invalidate"                   # הודעות "<kind>:<chat_id>", למשל settings:-100123
+
+class SettingsCache:
+    """
+    כל ה-Hash של הגדרות הצ'אט נטען ב-HGETALL אחד ונשמר בזיכרון עד ביטול או TTL,
+    כך שהגדרה חדשה לא מוסיפה קריאת Redis לכל עדכון.
+    לכל צ'אט יש מונה דורות ש-invalidate מקדם: תשובת HGETALL נשמרת רק אם לא הגיע ביטול
+    בזמן שהיא הייתה בדרך, כדי שערך ישן לא יידרוס את הביטול.
+    """
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._data = {}
+        self._gens = {}   # chat_id -> מספר הביטולים עד עכשיו
+        self._epoch = 0   # clear() מבטל את כל הצ'אטים בבת אחת
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def get_all(self, chat_id: int) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(chat_id)
+            if item and item[0] > now:
+                self.stats["hits"] += 1
+                return item[1]
+            self.stats["misses"] += 1
+            gen = (self._epoch, self._gens.get(chat_id, 0))
+        values = redis_call(lambda: r.hgetall(_k_settings(chat_id)), default=None)
+        if values is None:
+            return {}  # Redis לא זמין – לא שומרים תשובה ריקה ב-cache
+        with self._lock:
+            if gen == (self._epoch, self._gens.get(chat_id, 0)):
+                self._data[chat_id] = (now + self.ttl, values)
+        return values
+
+    def invalidate(self, chat_id: int):
+        with self._lock:
+            self._data.pop(chat_id, None)
+            self._gens[chat_id] = self._gens.get(chat_id, 0) + 1
+            self.stats["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._gens.clear()
+            self._epoch += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats, size=len(self._data))
+
+settings_cache = SettingsCache(SETTINGS_TTL)
+
+_invalidators = {"settings": settings_cache.invalidate, "admins": admin_cache.pop}
+
+def publish_invalidation(kind: str, chat_id: int):
+    if CACHE_PUBSUB:
+        redis_call(lambda: r.publish(INVALIDATE_CHANNEL, f"{kind}:{chat_id}"))
+
+def _invalidation_listener():
+    """
+    מאזין לערוץ הביטול ומוחק רשומות מקומיות. אחרי כל (re)subscribe מרוקנים הכל,
+    כי הודעות שנשלחו בזמן הניתוק לא יגיעו.
+    """
+    while True:
+        ps = None
         try:
-            out.append(json.loads(v))
-        except Exception:
-            pass
-    return out
+            ps = r.pubsub(ignore_subscribe_messages=True)
+            ps.subscribe(INVALIDATE_CHANNEL)
+            settings_cache.clear()
+            admin_cache.clear()
+            while True:
+                msg = ps.get_message(timeout=1.0)
+                if not msg or msg.get("type") != "message":
+                    continue
+                kind, _, cid = str(msg["data"]).partition(":")
+                handler = _invalidators.get(kind)
+                if handler and cid.lstrip("-").isdigit():
+                    handler(int(cid))
+        except Exception as e:
+            print("❌ cache pubsub listener:", repr(e))
+            time.sleep(2)
+        finally:
+            if ps is not None:
+                try:
+                    ps.close()
+                except Exception:
+                    pass
+
+if CACHE_PUBSUB:
+    background_tasks.append(_invalidation_listener)
 
 def get_setting(chat_id: int, key: str, default=None):
-    v = redis_call(lambda: r.hget(_k_settings(chat_id), key), default=None)
+    v = settings_cache.get_all(chat_id).get(key)
     if v is None:
         return default
     if v in ("1","0"):
@@ -221,32 +908,1282 @@ def set_setting(chat_id: int, key: str, value):
     if isinstance(value, bool):
         value = "1" if value else "0"
     redis_call(lambda: r.hset(_k_settings(chat_id), key, str(value)))
+    settings_cache.invalidate(chat_id)
+    publish_invalidation("settings", chat_id)
 
-# ---------- /dotall ברקע (ללא תיוג בוטים) ----------
-def run_dotall(chat_id: int, ids: list[int]):
-    total_sent = 0
-    batch = []
+# ---------- מיגרציה של חברים: פורמט שמירה + chat:{id}:ids ----------
+MIGRATE_MEMBERS = os.getenv("MIGRATE_MEMBERS", "0") == "1"   # להריץ ברקע בעליית ה-worker
+MIGRATE_PAUSE = float(os.getenv("MIGRATE_PAUSE", "0.01"))     # הפסקה בין pages כדי לא להעמיס על Upstash
 
-    # ניקוי בוטים שעשויים להיות ב-DB (ירושה היסטורית)
-    users_data = export_users(chat_id)
-    bots_ids = {
-        u["id"] for u in users_data
-        if ((u.get("username") or "").lower().endswith("bot"))
-    }
+# החלפה מותנית לכל page: ערך נכתב מחדש רק אם לא השתנה מאז שנקרא, ו-uid נכנס ל-ids רק אם עדיין קיים.
+# KEYS[1]=members KEYS[2]=ids ; ARGV: שלשות uid, ערך שנקרא, ערך חדש ('' = בלי המרה)
+_MIGRATE_PAGE_LUA = """
+local n = 0
+for i = 1, #ARGV, 3 do
+  local cur = redis.call('HGET', KEYS[1], ARGV[i])
+  if cur then
+    redis.call('SADD', KEYS[2], ARGV[i])
+    if ARGV[i+2] ~= '' and cur == ARGV[i+1] then
+      redis.call('HSET', KEYS[1], ARGV[i], ARGV[i+2])
+      n = n + 1
+    end
+  end
+end
+return n
+"""
+_migrate_page = r.register_script(_MIGRATE_PAGE_LUA)
+
+def iter_member_keys():
+    cursor = 0
+    while True:
+        cursor, keys = r.scan(cursor, match="chat:*:members", count=500)
+        yield from keys
+        if not cursor:
+            return
+
+# locks של משימות רקע (מיגרציה, reconcile): כמו ה-lease של /dotall, ה-lock מחזיק token
+# ומחודש ומשוחרר רק אם ה-token עדיין שלנו, כך ש-worker שה-lock שלו פג לא מוחק (או מאריך)
+# lock של worker אחר שכבר תפס אותו.
+_LOCK_RENEW_LUA = """
+-- KEYS: lock | ARGV: token, ttl_s – 1 = חודש, 0 = ה-lock לא שלנו
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then return 0 end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+_lock_renew = r.register_script(_LOCK_RENEW_LUA)
+
+_LOCK_RELEASE_LUA = """
+-- KEYS: lock | ARGV: token
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then return 0 end
+return redis.call('DEL', KEYS[1])
+"""
+_lock_release = r.register_script(_LOCK_RELEASE_LUA)
+
+def _renew_lock(key: str, token: str, ttl: int) -> bool:
+    """False רק אם ה-lock כבר לא שלנו; כש-Redis לא עונה ממשיכים (הקריאה הבאה תיכשל בכל מקרה)."""
+    return redis_call(lambda: _lock_renew(keys=[key], args=[token, ttl], client=r)) != 0
+
+_K_MIGRATE_LOCK = "members:migrating"  # String: token של ה-worker שמריץ את המיגרציה
+
+def migrate_chat_members(chat_id: int, pause: float = 0.0, lock_token: str | None = None):
+    """
+    ממיר במקום את כל הערכים של הצ'אט ל-MEMBER_FORMAT ובונה את chat:{id}:ids.
+    בסוף מסמן את הצ'אט ב-members:ids_ready כדי ש-/dotall יעבור לסט המזהים.
+    מחזיר (נסרקו, הומרו), או None אם Redis נפל באמצע (או שה-lock של המיגרציה אבד).
+    """
+    key = _k_members(chat_id)
+    want_packed = MEMBER_FORMAT == "packed"
+    scanned = converted = 0
+    cursor = 0
+    while True:
+        page = redis_call(lambda: r.hscan(key, cursor, count=SCAN_COUNT), default=None)
+        if page is None:
+            return None
+        cursor, items = page
+        args = []
+        for uid, raw in items.items():
+            new = ""
+            if raw.startswith(PackedCodec.PREFIX) != want_packed:
+                try:
+                    new = member_codec.encode(decode_member(uid, raw))
+                except Exception:
+                    pass
+            args += [uid, raw, new]
+        if args:
+            keys = [key, _k_ids(chat_id)]
+            converted += int(redis_call(lambda: _migrate_page(keys=keys, args=args, client=r), default=0) or 0)
+        scanned += len(items)
+        if not cursor:
+            break
+        if lock_token and not _renew_lock(_K_MIGRATE_LOCK, lock_token, 3600):
+            return None
+        if pause:
+            time.sleep(pause)
+    redis_call(lambda: r.sadd(_K_IDS_READY, chat_id))
+    return scanned, converted
+
+def migrate_all_members(pause: float = 0.0, lock_token: str | None = None):
+    chats = scanned = converted = 0
+    for key in redis_call(lambda: list(iter_member_keys()), default=[]):
+        if lock_token and not _renew_lock(_K_MIGRATE_LOCK, lock_token, 3600):
+            print("⚠️ migrate-members: lost members:migrating to another worker, stopping")
+            return
+        res = migrate_chat_members(int(key.split(":")[1]), pause, lock_token)
+        if res is None:
+            print(f"❌ migrate {key}: Redis unavailable, will retry on next run")
+            continue
+        chats += 1
+        scanned += res[0]
+        converted += res[1]
+    print(f"✅ migrate-members ({MEMBER_FORMAT}): {chats} chats, {scanned} members, {converted} converted")
+
+def _background_migration():
+    # רק worker אחד מריץ את המיגרציה; ה-lock מתחדש אחרי כל page
+    token = _lease_token()
+    if not redis_call(lambda: r.set(_K_MIGRATE_LOCK, token, nx=True, ex=3600), default=False):
+        return
+    try:
+        migrate_all_members(MIGRATE_PAUSE, token)
+    finally:
+        redis_call(lambda: _lock_release(keys=[_K_MIGRATE_LOCK], args=[token], client=r))
+
+if MIGRATE_MEMBERS:
+    background_tasks.append(_background_migration)
+
+# ---------- /dotall: מתזמן שליחה עם הגבלת קצב (ללא תיוג בוטים) ----------
+DOTALL_CHAT_RATE = float(os.getenv("DOTALL_CHAT_RATE_PER_MIN", "20")) / 60.0  # הודעות לשנייה בקבוצה אחת
+DOTALL_CHAT_BURST = int(os.getenv("DOTALL_CHAT_BURST", "5"))
+DOTALL_GLOBAL_RATE = float(os.getenv("DOTALL_GLOBAL_RATE", "25"))           # הודעות לשנייה לכל הבוט
+DOTALL_WORKERS = int(os.getenv("DOTALL_WORKERS", "2"))
+DOTALL_MAX_ATTEMPTS = int(os.getenv("DOTALL_MAX_ATTEMPTS", "5"))            # לשגיאה שאינה 429
+DOTALL_RESUME = os.getenv("DOTALL_RESUME", "1") == "1"
+DOTALL_LEASE_TTL = float(os.getenv("DOTALL_LEASE_TTL", "30"))              # שניות עד שעובד אחר יכול לאמץ job
+
+def _k_job(chat_id: int) -> str:     return f"dotall:job:{chat_id}"         # Hash: cursor/offset/sent/...
+def _k_lease(chat_id: int) -> str:   return f"dotall:lease:{chat_id}"       # String: token של העובד שמריץ
+_K_JOBS = "dotall:jobs"                                                    # Set: צ'אטים עם job פתוח
+
+# ---- lease לכל צ'אט: בדיוק עובד אחד (בכל התהליכים) מריץ את ה-job ----
+# הבעלים מחזיק dotall:lease:{chat} עם token משלו ו-TTL, ומחדש אותו בכל שמירת התקדמות
+# וב-heartbeat. כל הכתיבות ל-job עוברות דרך הסקריפטים ומגודרות ב-token, כך שעובד שאיבד
+# את ה-lease לא דורס התקדמות של מי שאימץ את ה-job. ביטול = השדה cancel ב-hash של ה-job.
+_DOTALL_ACQUIRE_LUA = """
+-- KEYS: lease, job, jobs | ARGV: token, ttl_ms, chat_id, fresh, field, value, ...
+if not redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then return 0 end
+if ARGV[4] == '1' then
+  redis.call('DEL', KEYS[2])
+  redis.call('HSET', KEYS[2], unpack(ARGV, 5))
+  redis.call('SADD', KEYS[3], ARGV[3])
+end
+return 1
+"""
+_dotall_acquire = r.register_script(_DOTALL_ACQUIRE_LUA)
+
+_DOTALL_SAVE_LUA = """
+-- KEYS: lease, job | ARGV: token, ttl_ms, field, value, ... (בלי שדות = heartbeat בלבד)
+-- מחזיר 1 = בסדר, 0 = ה-lease אצל עובד אחר (או שה-job כבר נמחק), 2 = בוטל
+if redis.call('EXISTS', KEYS[2]) == 0 then return 0 end
+local owner = redis.call('GET', KEYS[1])
+if owner and owner ~= ARGV[1] then return 0 end
+if redis.call('HEXISTS', KEYS[2], 'cancel') == 1 then return 2 end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+if #ARGV > 2 then redis.call('HSET', KEYS[2], unpack(ARGV, 3)) end
+return 1
+"""
+_dotall_save = r.register_script(_DOTALL_SAVE_LUA)
+
+_DOTALL_RELEASE_LUA = """
+-- KEYS: lease, job, jobs | ARGV: token, chat_id – מנקה רק אם ה-lease עדיין שלנו (או פג)
+local owner = redis.call('GET', KEYS[1])
+if owner and owner ~= ARGV[1] then return 0 end
+redis.call('DEL', KEYS[1], KEYS[2])
+redis.call('SREM', KEYS[3], ARGV[2])
+return 1
+"""
+_dotall_release = r.register_script(_DOTALL_RELEASE_LUA)
+
+_DOTALL_CANCEL_LUA = """
+-- KEYS: job | מסמן ביטול רק ל-job קיים; מחזיר sent/total לתשובה, או {} אם אין job
+if redis.call('EXISTS', KEYS[1]) == 0 then return {} end
+redis.call('HSET', KEYS[1], 'cancel', '1')
+return redis.call('HMGET', KEYS[1], 'sent', 'total')
+"""
+_dotall_cancel = r.register_script(_DOTALL_CANCEL_LUA)
+
+def _lease_token() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        # כמה שניות עד שיש אסימון שלם (0 = אפשר עכשיו)
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        # מותר לרדת מתחת לאפס: שליחות שלא עוברות דרך המתזמן "לוות" מהתקציב
+        self._refill(now)
+        self.tokens -= 1
+
+class DotallJob:
+    """
+    job של /dotall שקורא את חברי הקבוצה ב-HSCAN תוך כדי שליחה – בזיכרון יש לכל היותר page אחד.
+    בוטים מסוננים בצד השרת מול chat:{id}:bots (ראו _DOTALL_PAGE_LUA ו-backfill-bots).
+    מצב ההמשך הוא (cursor, offset): ה-cursor של ה-page שממנו מגיע המזהה הבא שלא נשלח,
+    וכמה מזהים מתוכו כבר נשלחו. cursor=-1 אומר שהמעבר הסתיים.
+    """
+    def __init__(self, chat_id: int, total: int, cursor: int = 0, offset: int = 0, sent: int = 0,
+                 messages: int = 0, started_at: float | None = None, src: str = "members",
+                 token: str | None = None, started_by: int = 0):
+        self.chat_id = chat_id
+        self.token = token or _lease_token()  # ה-token שמחזיק את dotall:lease:{chat}
+        self.started_by = started_by
+        self.stopped = None         # None, "cancelled" או "lost" (ה-lease עבר לעובד אחר)
+        self.running = False        # worker של המתזמן מריץ עכשיו צעד של ה-job
+        self.lease_ok_at = time.monotonic()
+        self.src = src              # ids (SSCAN על chat:{id}:ids) או members (HSCAN) – קבוע לכל ה-job
+        self.total = total          # HLEN בתחילת ה-job – הערכה להתקדמות בלבד
+        self.cursor = cursor
+        self.offset = offset
+        self.sent = sent
+        self.messages = messages
+        self.started_at = started_at or time.time()
+        self.attempts = 0           # sendMessage שנדחה ברצף על אותה הודעה
+        self.read_failures = 0      # קריאות page רצופות ש-Redis לא ענה להן
+        self.scan_done = cursor < 0
+        self._next_cursor = None    # None = עוד לא נקרא page מאז שה-job נטען
+        self._buf = deque()         # (page_cursor, index_in_page, uid)
+
+    def _fill(self) -> bool:
+        while len(self._buf) < MENTION_CHUNK and not self.scan_done:
+            first = self._next_cursor is None
+            cur = self.cursor if first else self._next_cursor
+            # ✅ לא מתייג בוטים – הסינון מול chat:{id}:bots נעשה ב-Redis
+            src_key = _k_ids(self.chat_id) if self.src == "ids" else _k_members(self.chat_id)
+            keys = [src_key, _k_bots(self.chat_id)]
+            page = redis_call(lambda: _dotall_page(keys=keys, args=[cur, SCAN_COUNT, self.src], client=r),
+                              default=None)
+            if page is None:
+                return False
+            for idx, uid in enumerate(page[1:]):
+                if not (first and idx < self.offset):
+                    self._buf.append((cur, idx, uid))
+            self._next_cursor = int(page[0])
+            self.scan_done = self._next_cursor == 0
+        return True
+
+    def next_chunk(self):
+        """המזהים להודעה הבאה (בלי לסמן כנשלחו), [] בסוף, או None אם Redis לא ענה."""
+        if not self._fill():
+            return None
+        return [uid for _, _, uid in itertools.islice(self._buf, MENTION_CHUNK)]
+
+    def commit(self, n: int):
+        for _ in range(min(n, len(self._buf))):
+            self._buf.popleft()
+        if self._buf:
+            self.cursor, self.offset, _ = self._buf[0]
+        elif self.scan_done:
+            self.cursor, self.offset = -1, 0
+        elif self._next_cursor is not None:
+            self.cursor, self.offset = self._next_cursor, 0
+        # אחרת עוד לא נקרא page – נשארים על ה-(cursor, offset) השמורים
+        self.save()
+
+    @property
+    def done(self) -> bool:
+        return self.scan_done and not self._buf
+
+    def fields(self) -> list:
+        return ["cursor", self.cursor, "offset", self.offset, "sent", self.sent, "messages", self.messages,
+                "total", self.total, "started_at", self.started_at, "src", self.src,
+                "started_by", self.started_by]
+
+    def save(self, fields: list | None = None):
+        """שומר התקדמות ומחדש את ה-lease; בלי fields זה heartbeat. מעדכן את stopped לפי התשובה."""
+        keys = [_k_lease(self.chat_id), _k_job(self.chat_id)]
+        args = [self.token, int(DOTALL_LEASE_TTL * 1000)] + (self.fields() if fields is None else fields)
+        res = redis_call(lambda: _dotall_save(keys=keys, args=args, client=r), default=None)
+        if res is None:
+            return None
+        self.lease_ok_at = time.monotonic()
+        if res == 0:
+            self.stopped = self.stopped or "lost"
+        elif res == 2:
+            self.stopped = self.stopped or "cancelled"
+        return res
+
+    def heartbeat(self):
+        return self.save(fields=[])
+
+    @property
+    def lease_stale(self) -> bool:
+        # בלי אישור מ-Redis במשך TTL אחר יכול לאמץ את ה-job – לא שולחים עד שה-lease מתחדש
+        return time.monotonic() - self.lease_ok_at > DOTALL_LEASE_TTL
+
+class SendScheduler:
+    """
+    מתזמן מרכזי לשליחות /dotall: job אחד פעיל לכל צ'אט, token bucket לכל צ'אט ואחד גלובלי,
+    וכיבוד retry_after בתשובת 429. ה-jobs ממתינים ב-heap לפי זמן מוכנות, כך ש-thread
+    לא נתקע על צ'אט חסום בזמן שצ'אט אחר יכול לשלוח. ההתקדמות נשמרת ב-Redis אחרי כל הודעה.
+    """
+    def __init__(self, workers: int):
+        self.workers = max(1, workers)
+        self.jobs = {}
+        self.global_bucket = TokenBucket(DOTALL_GLOBAL_RATE, max(1, int(DOTALL_GLOBAL_RATE)))
+        self.chat_buckets = {}
+        self.blocked_until = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._cv = threading.Condition()
+        self._threads = []
+        self.stats = {"jobs_done": 0, "messages_sent": 0, "mentions_sent": 0,
+                      "retries_429": 0, "errors": 0, "cancelled": 0, "leases_lost": 0, "last_job": None}
+
+    def active(self, chat_id: int) -> bool:
+        with self._cv:
+            return chat_id in self.jobs
+
+    def submit(self, job: DotallJob) -> bool:
+        with self._cv:
+            if job.chat_id in self.jobs:
+                return False
+            self.jobs[job.chat_id] = job
+            self.chat_buckets.setdefault(job.chat_id, TokenBucket(DOTALL_CHAT_RATE, DOTALL_CHAT_BURST))
+            self._push(time.monotonic(), job)
+            if not self._threads:
+                for target in [self._run] * self.workers + [self._heartbeat]:
+                    t = threading.Thread(target=target, daemon=True)
+                    t.start()
+                    self._threads.append(t)
+        return True
+
+    def stop(self, chat_id: int, reason: str) -> bool:
+        """עוצר job מקומי לפני ההודעה הבאה שלו (גם אם הוא ממתין ל-429/rate limit)."""
+        with self._cv:
+            job = self.jobs.get(chat_id)
+            if job is None:
+                return False
+            job.stopped = job.stopped or reason
+            self._wake(job)
+        return True
+
+    def _wake(self, job: DotallJob):
+        # job שממתין ב-heap מקבל רשומה מיידית; job שרץ עכשיו ייעצר כשהצעד שלו יחזור
+        if not job.running:
+            self._push(time.monotonic(), job)
+
+    def _heartbeat(self):
+        # מחדש את ה-lease של כל job מקומי, גם כשהוא ממתין הרבה זמן בין הודעות
+        while True:
+            time.sleep(DOTALL_LEASE_TTL / 3)
+            with self._cv:
+                jobs = list(self.jobs.values())
+            for job in jobs:
+                if job.stopped is None and job.heartbeat() in (0, 2):
+                    with self._cv:
+                        self._wake(job)
+
+    def debit_global(self):
+        with self._cv:
+            self.global_bucket.take(time.monotonic())
+
+    def _push(self, ready_at: float, job: DotallJob):
+        heapq.heappush(self._heap, (ready_at, next(self._seq), job))
+        self._cv.notify()
+
+    def _run(self):
+        while True:
+            with self._cv:
+                while True:
+                    now = time.monotonic()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    self._cv.wait(self._heap[0][0] - now if self._heap else None)
+                _, _, job = heapq.heappop(self._heap)
+                if self.jobs.get(job.chat_id) is not job:
+                    continue  # רשומה ישנה ב-heap של job שכבר הסתיים
+                stopped = job.stopped is not None
+                if not stopped:
+                    if job.lease_stale:
+                        self._push(now + min(5.0, DOTALL_LEASE_TTL / 3), job)
+                        continue
+                    # צריך גם אסימון של הצ'אט וגם גלובלי; אם חסר – חוזרים ל-heap בלי לצרוך
+                    bucket = self.chat_buckets[job.chat_id]
+                    wait = max(bucket.wait_time(now), self.global_bucket.wait_time(now),
+                               self.blocked_until.get(job.chat_id, 0) - now)
+                    if wait > 0:
+                        self._push(now + wait, job)
+                        continue
+                    bucket.take(now)
+                    self.global_bucket.take(now)
+                job.running = True
+            delay = None
+            if not stopped:
+                try:
+                    delay = self._step(job)
+                except Exception as e:
+                    print("❌ dotall step error:", repr(e))
+                    delay = self._failed(job)
+            if delay is None or job.stopped:
+                self._finish(job)
+            else:
+                with self._cv:
+                    job.running = False
+                    self._push(time.monotonic() + delay, job)
+
+    def _step(self, job: DotallJob):
+        """שולח הודעה אחת של ה-job. מחזיר השהייה עד הצעד הבא, או None כשה-job הסתיים."""
+        ids = job.next_chunk()
+        if ids is None:
+            return self._read_failed(job)
+        job.read_failures = 0
+        if not ids:
+            job.commit(0)
+            return None
+        text = " ".join(f"[.](tg://user?id={uid})" for uid in ids)
+        rsp = api.post("sendMessage", {"chat_id": job.chat_id, "text": text, "parse_mode": "Markdown",
+                                       "disable_web_page_preview": True})
+        if rsp.status_code == 429:
+            retry_after = 5
+            try:
+                retry_after = int(rsp.json().get("parameters", {}).get("retry_after", retry_after))
+            except Exception:
+                pass
+            with self._cv:
+                self.blocked_until[job.chat_id] = time.monotonic() + retry_after
+                self.stats["retries_429"] += 1
+            return 0.0
+        if not rsp.ok:
+            print("dotall send fail:", rsp.status_code, rsp.text)
+            return self._failed(job)
+        job.attempts = 0
+        job.sent += len(ids)
+        job.messages += 1
+        job.commit(len(ids))
+        with self._cv:
+            self.stats["messages_sent"] += 1
+            self.stats["mentions_sent"] += len(ids)
+        dotall_messages.inc()
+        dotall_mentions.inc(amount=len(ids))
+        return None if job.done else 0.0
 
-    for uid in ids:
-        if uid in bots_ids:      # ✅ לא מתייג בוטים
+    def _read_failed(self, job: DotallJob):
+        # Redis לא ענה על ה-page: רק backoff ואותה קריאה שוב – לא מדלגים על מזהים שעוד לא נשלחו
+        job.read_failures += 1
+        with self._cv:
+            self.stats["errors"] += 1
+        return min(30.0, 2.0 ** job.read_failures)
+
+    def _failed(self, job: DotallJob):
+        # sendMessage נדחה: backoff, ואחרי DOTALL_MAX_ATTEMPTS מדלגים על ההודעה הזו
+        job.attempts += 1
+        with self._cv:
+            self.stats["errors"] += 1
+        if job.attempts >= DOTALL_MAX_ATTEMPTS:
+            print(f"❌ dotall chat {job.chat_id}: skipping chunk at cursor {job.cursor}+{job.offset}")
+            job.attempts = 0
+            job.commit(MENTION_CHUNK)
+            return None if job.done else 0.0
+        return min(30.0, 2.0 ** job.attempts)
+
+    def _finish(self, job: DotallJob):
+        duration = max(time.time() - job.started_at, 0.001)
+        with self._cv:
+            self.jobs.pop(job.chat_id, None)
+            self.chat_buckets.pop(job.chat_id, None)
+            self.blocked_until.pop(job.chat_id, None)
+            if job.stopped == "lost":
+                self.stats["leases_lost"] += 1
+            else:
+                self.stats["cancelled" if job.stopped else "jobs_done"] += 1
+                self.stats["last_job"] = {
+                    "chat_id": job.chat_id, "mentions": job.sent, "messages": job.messages,
+                    "duration_s": round(duration, 2), "mentions_per_s": round(job.sent / duration, 2),
+                    "cancelled": job.stopped == "cancelled",
+                }
+        if job.stopped == "lost":
+            # עובד אחר אימץ את ה-job – הוא ממשיך מההתקדמות השמורה, ואנחנו לא נוגעים במפתחות
+            print(f"↪ dotall chat {job.chat_id}: lease taken over after {job.sent}/{job.total}")
+            return
+        state = "cancelled" if job.stopped else "done"
+        print(f"✅ dotall chat {job.chat_id} {state}: {job.sent} mentions / {job.messages} msgs in {duration:.1f}s")
+        dotall_duration.observe(duration)
+        keys = [_k_lease(job.chat_id), _k_job(job.chat_id), _K_JOBS]
+        redis_call(lambda: _dotall_release(keys=keys, args=[job.token, job.chat_id], client=r))
+
+    def snapshot(self) -> dict:
+        with self._cv:
+            active = {cid: {"sent": j.sent, "total": j.total} for cid, j in self.jobs.items()}
+            return dict(self.stats, active=active, waiting=len(self._heap))
+
+scheduler = SendScheduler(DOTALL_WORKERS)
+
+def start_dotall(chat_id: int, started_by: int = 0) -> bool:
+    """
+    יוצר job חדש ל-/dotall ותופס את ה-lease של הצ'אט. מחזיר False אם כבר יש job פעיל
+    (בתהליך הזה או בעובד אחר – ראו dotall_progress) או ש-Redis לא זמין.
+    """
+    if scheduler.active(chat_id):
+        return False
+    ids_ready = redis_call(lambda: r.sismember(_K_IDS_READY, chat_id), default=False)
+    job = DotallJob(chat_id, total=count_users(chat_id), src="ids" if ids_ready else "members",
+                    started_by=started_by)
+    keys = [_k_lease(chat_id), _k_job(chat_id), _K_JOBS]
+    args = [job.token, int(DOTALL_LEASE_TTL * 1000), chat_id, "1"] + job.fields()
+    if not redis_call(lambda: _dotall_acquire(keys=keys, args=args, client=r), default=0):
+        return False
+    return scheduler.submit(job)
+
+def dotall_progress(chat_id: int):
+    """(sent, total) של ה-job הפעיל בצ'אט – מכל עובד – או None אם אין."""
+    def _read():
+        pipe = r.pipeline()
+        pipe.exists(_k_lease(chat_id))
+        pipe.hmget(_k_job(chat_id), "sent", "total")
+        return pipe.execute()
+    res = redis_call(_read, default=None)
+    if not res or not res[0] or res[1][0] is None:
+        return None
+    return int(res[1][0]), int(res[1][1] or 0)
+
+def cancel_dotall(chat_id: int):
+    """
+    מסמן ביטול ל-job של הצ'אט; העובד שמחזיק את ה-lease עוצר בשמירה או ב-heartbeat הבאים
+    (אם הוא בתהליך הזה – מיד). מחזיר (sent, total) אם היה job, אחרת None.
+    """
+    res = redis_call(lambda: _dotall_cancel(keys=[_k_job(chat_id)], client=r), default=None)
+    scheduler.stop(chat_id, "cancelled")
+    if not res:
+        return None
+    return int(res[0] or 0), int(res[1] or 0)
+
+def resume_dotall_jobs():
+    """
+    ממשיך jobs שנשמרו ב-Redis ואין להם בעלים: אחרי restart, או כשה-lease של עובד
+    אחר פג (נפל/נתקע). SET NX על ה-lease מבטיח שרק עובד אחד מאמץ כל job.
+    """
+    for cid in redis_call(lambda: r.smembers(_K_JOBS), default=set()) or ():
+        chat_id = int(cid)
+        if scheduler.active(chat_id):
+            continue
+        token = _lease_token()
+        keys = [_k_lease(chat_id), _k_job(chat_id), _K_JOBS]
+        if not redis_call(lambda: _dotall_acquire(keys=keys, args=[token, int(DOTALL_LEASE_TTL * 1000), chat_id, "0"],
+                                                  client=r), default=0):
             continue
-        batch.append(f"[.](tg://user?id={uid})")
-        if len(batch) >= MENTION_CHUNK:
-            send_message(chat_id, " ".join(batch), parse_mode="Markdown")
-            total_sent += len(batch)
-            batch = []
-            time.sleep(MENTION_DELAY)
+        h = redis_call(lambda: r.hgetall(_k_job(chat_id)), default=None)
+        if not h or h.get("cancel"):
+            redis_call(lambda: _dotall_release(keys=keys, args=[token, chat_id], client=r))
+            continue
+        job = DotallJob(chat_id, total=int(h.get("total", 0)), cursor=int(h.get("cursor", 0)),
+                        offset=int(h.get("offset", 0)), sent=int(h.get("sent", 0)),
+                        messages=int(h.get("messages", 0)), started_at=float(h.get("started_at", 0)) or None,
+                        src=h.get("src", "members"), token=token, started_by=int(h.get("started_by", 0)))
+        if scheduler.submit(job):
+            print(f"↻ dotall chat {chat_id}: resuming after {job.sent}/{job.total}")
+
+def _adopt_orphaned_jobs():
+    # בעלייה, ואחר כך פעם ב-DOTALL_LEASE_TTL: SMEMBERS אחד, ו-SET NX רק ל-jobs שאינם מקומיים
+    while True:
+        resume_dotall_jobs()
+        time.sleep(DOTALL_LEASE_TTL)
+
+if DOTALL_RESUME:
+    background_tasks.append(_adopt_orphaned_jobs)
+
+# ---------- Reconciliation: ניקוי חברים שעזבו בלי שהגיע עדכון ----------
+# chat:{id}:members מתעדכן רק מ-left_chat_member/chat_member; עדכון שהוחמץ משאיר מזהה ש-/dotall
+# ימשיך לתייג. worker אחד (reconcile:lock) עובר על החברים ב-HSCAN ובודק כל אחד ב-getChatMember,
+# בתקציב קצב ומקביליות משלו. ההתקדמות נשמרת ב-reconcile:{chat} כך שאחרי restart ממשיכים מה-cursor,
+# וצ'אט שנסרק עד הסוף נבדק שוב רק אחרי RECONCILE_INTERVAL.
+RECONCILE = os.getenv("RECONCILE", "0") == "1"
+RECONCILE_RATE = float(os.getenv("RECONCILE_RATE", "5"))                     # getChatMember לשנייה
+RECONCILE_CONCURRENCY = int(os.getenv("RECONCILE_CONCURRENCY", "4"))         # בקשות במקביל
+RECONCILE_INTERVAL = float(os.getenv("RECONCILE_INTERVAL", str(7 * 86400)))  # שניות בין סריקות מלאות של צ'אט
+RECONCILE_MIN_AGE = float(os.getenv("RECONCILE_MIN_AGE", "86400"))           # חברים שנוספו לאחרונה לא נבדקים
+RECONCILE_PAUSE = float(os.getenv("RECONCILE_PAUSE", "3600"))                # שניות בין מעברים על כל הצ'אטים
+GONE_STATUSES = {"left", "kicked"}
+
+def _k_reconcile(chat_id: int) -> str: return f"reconcile:{chat_id}"  # Hash: cursor/running/checked/pruned/total/...
+_K_RECONCILE_LOCK = "reconcile:lock"                                   # String: token של ה-worker שסורק
 
-    if batch:
-        send_message(chat_id, " ".join(batch), parse_mode="Markdown")
-        total_sent += len(batch)
+reconcile_checked = Counter("reconcile_checked_total", "Stored members checked with getChatMember")
+reconcile_pruned = Counter("reconcile_pruned_total", "Stored members pruned because they left the chat")
+
+class Reconciler:
+    def __init__(self, rate: float, concurrency: int):
+        self.bucket = TokenBucket(rate, max(1, int(rate)))
+        self.concurrency = max(1, concurrency)
+        self._bucket_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self.stats = {"sweeps": 0, "checked": 0, "pruned": 0, "skipped_recent": 0,
+                      "errors": 0, "retries_429": 0, "last_sweep": None}
+        self.lock_token = None  # token של reconcile:lock כשרץ ברקע; None = הרצה ידנית בלי lock
+
+    def _count(self, key: str, n: int = 1):
+        with self._lock:
+            self.stats[key] += n
+
+    def _take(self):
+        # תקציב משותף לכל ה-threads של ה-reconciler – נפרד מהתקציב של /dotall
+        while True:
+            with self._bucket_lock:
+                now = time.monotonic()
+                wait = self.bucket.wait_time(now)
+                if wait <= 0:
+                    self.bucket.take(now)
+                    return
+            time.sleep(wait)
+
+    def check(self, chat_id: int, user_id: int) -> str:
+        """'gone', 'member', 'bot_removed' (הבוט כבר לא בקבוצה) או 'error'."""
+        for _ in range(3):
+            self._take()
+            try:
+                rsp = api.get("getChatMember", {"chat_id": chat_id, "user_id": user_id}, timeout=10)
+                data = rsp.json()
+            except Exception:
+                self._count("errors")
+                return "error"
+            if rsp.status_code == 429:
+                self._count("retries_429")
+                time.sleep(int((data.get("parameters") or {}).get("retry_after", 5)))
+                continue
+            if rsp.ok:
+                res = data.get("result") or {}
+                status = res.get("status")
+                gone = status in GONE_STATUSES or (status == "restricted" and res.get("is_member") is False)
+                return "gone" if gone else "member"
+            desc = (data.get("description") or "").lower()
+            if "user not found" in desc or "participant_id_invalid" in desc:
+                return "gone"
+            if rsp.status_code == 403 or "chat not found" in desc:
+                return "bot_removed"
+            self._count("errors")
+            return "error"
+        return "error"
+
+    def sweep_chat(self, chat_id: int, executor, force: bool = False):
+        """ממשיך (או מתחיל) סריקה של צ'אט אחד. מחזיר את מצב הסריקה, או None אם לא היה מה לעשות."""
+        key, state_key = _k_members(chat_id), _k_reconcile(chat_id)
+        state = redis_call(lambda: r.hgetall(state_key), default=None)
+        if state is None:
+            return None
+        now = time.time()
+        if state.get("running") != "1":
+            if not force and now - float(state.get("finished_at") or 0) < RECONCILE_INTERVAL:
+                return None
+            total = int(redis_call(lambda: r.hlen(key), default=0) or 0)
+            state = {"cursor": "0", "running": "1", "checked": "0", "pruned": "0",
+                     "total": str(total), "started_at": str(int(now))}
+            redis_call(lambda: r.hset(state_key, mapping=state))
+        cursor, checked, pruned = int(state["cursor"]), int(state["checked"]), int(state["pruned"])
+        while True:
+            page = redis_call(lambda: r.hscan(key, cursor, count=SCAN_COUNT), default=None)
+            if page is None:
+                return None  # Redis לא זמין – ממשיכים מה-cursor השמור במעבר הבא
+            next_cursor, items = page
+            candidates = []
+            for uid, raw in items.items():
+                try:
+                    added_at = decode_member(uid, raw).get("added_at") or 0
+                except Exception:
+                    added_at = 0
+                if now - added_at < RECONCILE_MIN_AGE:
+                    self._count("skipped_recent")
+                else:
+                    candidates.append(int(uid))
+            results = list(executor.map(lambda uid: self.check(chat_id, uid), candidates))
+            if "bot_removed" in results:
+                print(f"⚠️ reconcile chat {chat_id}: bot is not in the chat, stopping")
+                next_cursor = 0
+            gone = [uid for uid, res in zip(candidates, results) if res == "gone"]
+            if gone:
+                apply_member_ops({(chat_id, uid): None for uid in gone})
+            checked += len(candidates)
+            pruned += len(gone)
+            self._count("checked", len(candidates))
+            self._count("pruned", len(gone))
+            reconcile_checked.inc(amount=len(candidates))
+            reconcile_pruned.inc(amount=len(gone))
+            cursor = int(next_cursor)
+            redis_call(lambda: r.hset(state_key, mapping={"cursor": cursor, "checked": checked, "pruned": pruned}))
+            token = self.lock_token
+            if token and not _renew_lock(_K_RECONCILE_LOCK, token, 600):
+                print(f"⚠️ reconcile chat {chat_id}: lost reconcile:lock, stopping")
+                return None  # worker אחר תפס את ה-lock וימשיך מה-cursor השמור
+            if not cursor:
+                break
+        total = int(state.get("total") or 0)
+        result = {"chat_id": chat_id, "total": total, "checked": checked, "pruned": pruned,
+                  "reduction_pct": round(100.0 * pruned / total, 2) if total else 0.0}
+        redis_call(lambda: r.hset(state_key, mapping={"running": "0", "finished_at": int(time.time())}))
+        with self._lock:
+            self.stats["sweeps"] += 1
+            self.stats["last_sweep"] = result
+        print(f"🧹 reconcile chat {chat_id}: pruned {pruned}/{total} ({result['reduction_pct']}% fewer mentions), "
+              f"checked {checked}")
+        return result
+
+    def run_once(self, chat_ids=None, force: bool = False) -> list:
+        """מעבר אחד על כל הצ'אטים (או על chat_ids). מחזיר את תוצאות הסריקות שהסתיימו."""
+        if chat_ids is None:
+            keys = redis_call(lambda: list(iter_member_keys()), default=None)
+            if keys is None:
+                print("❌ reconcile: Redis unavailable, will retry on next run")
+                return []
+            chat_ids = [int(k.split(":")[1]) for k in keys]
+        done = []
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            for chat_id in chat_ids:
+                res = self.sweep_chat(chat_id, executor, force=force)
+                if res:
+                    done.append(res)
+        return done
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats)
+
+reconciler = Reconciler(RECONCILE_RATE, RECONCILE_CONCURRENCY)
+
+def _background_reconcile():
+    # כמו במיגרציה: רק worker אחד סורק; ה-lock מתחדש אחרי כל page
+    while True:
+        token = _lease_token()
+        if redis_call(lambda: r.set(_K_RECONCILE_LOCK, token, nx=True, ex=600), default=False):
+            reconciler.lock_token = token
+            try:
+                reconciler.run_once()
+            except Exception as e:
+                print("❌ reconcile error:", repr(e))
+            finally:
+                reconciler.lock_token = None
+                redis_call(lambda: _lock_release(keys=[_K_RECONCILE_LOCK], args=[token], client=r))
+        time.sleep(RECONCILE_PAUSE)
+
+if RECONCILE:
+    background_tasks.append(_background_reconcile)
+
+# ---------- ייצוא לקובץ (/export, /bl_list) ----------
+# הקובץ נבנה תוך כדי HSCAN לקובץ זמני בדיסק (CSV או JSONL, אופציונלית gzip), כך שבזיכרון יש
+# לכל היותר page אחד. הבנייה והשליחה ב-sendDocument רצות ב-export_pool ולא ב-thread של
+# הבקשה; הודעת התקדמות נערכת כל EXPORT_PROGRESS_INTERVAL שניות.
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", "2"))
+EXPORT_FORMAT = os.getenv("EXPORT_FORMAT", "csv")              # csv | jsonl – כשלא צוין בפקודה
+EXPORT_GZIP = os.getenv("EXPORT_GZIP", "0") == "1"
+EXPORT_PROGRESS_INTERVAL = float(os.getenv("EXPORT_PROGRESS_INTERVAL", "3"))
+EXPORT_MAX_BYTES = 50 * 1024 * 1024                            # מגבלת sendDocument של Bot API
+EXPORT_FIELDS = ("id", "first_name", "last_name", "username", "added_at")
+
+export_pool = ThreadPoolExecutor(max(1, EXPORT_WORKERS), thread_name_prefix="export")
+_exports_running = set()  # (chat_id, kind) – ייצוא אחד מכל סוג לצ'אט בכל רגע
+_exports_lock = threading.Lock()
+
+def parse_export_args(arg: str | None):
+    """'/export jsonl gz' → ('jsonl', True). מילים לא מוכרות מתעלמים מהן."""
+    fmt, gz = EXPORT_FORMAT, EXPORT_GZIP
+    for word in (arg or "").lower().split():
+        if word in {"csv", "jsonl", "json"}:
+            fmt = "jsonl" if word == "json" else word
+        elif word in {"gz", "gzip"}:
+            gz = True
+    return fmt, gz
+
+def write_export(rows, fileobj, fmt: str = "csv", gz: bool = False, progress=None) -> int:
+    """כותב את rows ל-fileobj (בינארי) שורה אחרי שורה. מחזיר את מספר השורות."""
+    raw = gzip.GzipFile(fileobj=fileobj, mode="wb") if gz else fileobj
+    # utf-8-sig ל-CSV כדי ש-Excel יזהה עברית
+    text = io.TextIOWrapper(raw, encoding="utf-8-sig" if fmt == "csv" else "utf-8", newline="")
+    writer = csv.writer(text) if fmt == "csv" else None
+    if writer:
+        writer.writerow(EXPORT_FIELDS)
+    n = 0
+    for u in rows:
+        if writer:
+            writer.writerow([u.get(f) if u.get(f) is not None else "" for f in EXPORT_FIELDS])
+        else:
+            text.write(json.dumps({f: u.get(f) for f in EXPORT_FIELDS}, ensure_ascii=False) + "\n")
+        n += 1
+        if progress:
+            progress(n)
+    text.flush()
+    text.detach()  # לא סוגרים את fileobj – הוא עוד נשלח
+    if gz:
+        raw.close()
+    return n
+
+def run_export(chat_id: int, kind: str, fmt: str, gz: bool):
+    rows = iter_members(chat_id) if kind == "members" else iter_blacklist(chat_id)
+    label = "Export" if kind == "members" else "Blacklist"
+    status = send_message(chat_id, f"⏳ {label}: מכין קובץ...")
+    status_id = (status or {}).get("message_id")
+    last = [time.monotonic()]
+
+    def progress(n: int):
+        now = time.monotonic()
+        if status_id and now - last[0] >= EXPORT_PROGRESS_INTERVAL:
+            last[0] = now
+            edit_message(chat_id, status_id, f"⏳ {label}: {n} שורות...")
+
+    try:
+        with tempfile.TemporaryFile() as f:
+            n = write_export(rows, f, fmt, gz, progress)
+            size = f.tell()
+            if size > EXPORT_MAX_BYTES:
+                final = f"❌ {label}: הקובץ גדול מדי ({size // (1024 * 1024)}MB). נסו שוב עם gz."
+            else:
+                f.seek(0)
+                name = f"{kind}_{chat_id}_{time.strftime('%Y%m%d')}.{fmt}" + (".gz" if gz else "")
+                scheduler.debit_global()
+                rsp = api.post("sendDocument", {"chat_id": chat_id, "caption": f"{label}: {n} שורות"},
+                               files={"document": (name, f)}, timeout=120)
+                final = f"✅ {label}: {n} שורות" if rsp.ok else f"❌ {label}: השליחה נכשלה."
+                if not rsp.ok:
+                    print("sendDocument fail:", rsp.status_code, rsp.text)
+    except Exception as e:
+        print("❌ export error:", repr(e))
+        final = f"❌ {label}: הייצוא נכשל."
+    finally:
+        with _exports_lock:
+            _exports_running.discard((chat_id, kind))
+    if status_id:
+        edit_message(chat_id, status_id, final)
+
+def start_export(chat_id: int, kind: str, fmt: str, gz: bool) -> bool:
+    """מתזמן ייצוא ב-export_pool. False אם כבר רץ ייצוא כזה בצ'אט."""
+    with _exports_lock:
+        if (chat_id, kind) in _exports_running:
+            return False
+        _exports_running.add((chat_id, kind))
+    export_pool.submit(run_export, chat_id, kind, fmt, gz)
+    return True
+
+# ---------- פקודות בקבוצה: טבלת ניתוב ----------
+# כל פקודה נרשמת פעם אחת ב-COMMANDS (כולל כינויים), עם דרישת מנהל ו-cooldown לכל צ'אט.
+# הניתוב הוא חיפוש אחד ב-dict לפי ה-entity מסוג bot_command – בלי התאמת prefix,
+# כך ש-/counter לא נתפס כ-/count, והודעה בלי פקודה חוזרת מיד.
+CommandContext = namedtuple("CommandContext", "msg chat_id from_user text cmd arg")
+Command = namedtuple("Command", "name handler admin deny_text cooldown")
+
+COMMANDS = {}
+_cooldowns = {}                     # (chat_id, name) -> monotonic של ההרצה האחרונה
+_cooldowns_lock = threading.Lock()
+command_latency = Histogram("bot_command_seconds", "Group command handling time", labels=("command",))
+
+def command(*names, admin: bool = False, deny_text: str | None = None, cooldown: float = 0.0):
+    """
+    דקורטור לרישום handler של פקודה. admin=True – רק מנהלים (deny_text נשלח למי שנחסם,
+    None = התעלמות שקטה). cooldown – מינימום שניות בין הרצות של אותה פקודה באותו צ'אט.
+    """
+    def register(fn):
+        spec = Command(names[0], fn, admin, deny_text, cooldown)
+        for name in names:
+            COMMANDS[f"/{name}"] = spec
+        return fn
+    return register
+
+def parse_command(msg: dict):
+    """מחזיר (פקודה, ארגומנט) אם ההודעה מתחילה בפקודה רשומה, אחרת None."""
+    text = msg.get("text") or ""
+    cmd = None
+    for e in msg.get("entities") or ():
+        if e.get("type") == "bot_command":
+            # טלגרם מסמן פקודה בתחילת ההודעה ב-offset 0; פקודות באמצע הטקסט לא מפעילות
+            if e.get("offset", 0) != 0:
+                return None
+            cmd = text[:e.get("length", 0)]
+            break
+    if cmd is None:
+        # fallback אם משום מה אין entities: רק הטוקן הראשון, בהתאמה מלאה
+        head = text.lstrip().split(maxsplit=1)
+        if not head or not head[0].startswith("/"):
+            return None
+        cmd = head[0]
+    # מסירים @username אם נוסף (/count@mybot)
+    cmd = cmd.lower().split("@", 1)[0]
+    if cmd not in COMMANDS:
+        return None
+    parts = text.strip().split(maxsplit=1)
+    return cmd, (parts[1] if len(parts) > 1 else None)
+
+def _cooldown_hit(chat_id: int, spec: Command) -> bool:
+    if spec.cooldown <= 0:
+        return False
+    key, now = (chat_id, spec.name), time.monotonic()
+    with _cooldowns_lock:
+        if now - _cooldowns.get(key, -spec.cooldown) < spec.cooldown:
+            return True
+        _cooldowns[key] = now
+        if len(_cooldowns) > 10000:  # ניקוי רשומות ישנות כדי שהמילון לא יגדל בלי סוף
+            for k in [k for k, t in _cooldowns.items() if now - t > 3600]:
+                del _cooldowns[k]
+    return False
+
+def dispatch_command(ctx: CommandContext):
+    spec = COMMANDS[ctx.cmd]
+    started = time.perf_counter()
+    try:
+        if spec.admin and not is_admin(ctx.chat_id, ctx.from_user.get("id", 0)):
+            if spec.deny_text:
+                send_message(ctx.chat_id, spec.deny_text)
+            return
+        if _cooldown_hit(ctx.chat_id, spec):
+            return
+        spec.handler(ctx)
+    finally:
+        command_latency.observe(time.perf_counter() - started, spec.name)
+
+# ---- פקודות ----
+@command("whoami")
+def cmd_whoami(ctx: CommandContext):
+    uid = ctx.from_user.get("id")
+    isown = "✅" if (OWNER_ID and uid == OWNER_ID) else "❌"
+    send_message(ctx.chat_id, f"ID: {uid}\nOwner: {isown}")
+
+@command("count")
+def cmd_count(ctx: CommandContext):
+    send_message(ctx.chat_id, f"{count_users(ctx.chat_id)}")
+
+@command("export", admin=True, deny_text="רק מנהלים יכולים להשתמש ב-/export.", cooldown=10)
+def cmd_export(ctx: CommandContext):
+    if not count_users(ctx.chat_id):
+        send_message(ctx.chat_id, "אין נתונים.")
+        return
+    start_export(ctx.chat_id, "members", *parse_export_args(ctx.arg))
+
+@command("bl_add", "blacklist_add", admin=True, deny_text="רק מנהלים יכולים להשתמש ב-/bl_add.")
+def cmd_bl_add(ctx: CommandContext):
+    target = resolve_target_user(ctx.msg, ctx.arg)
+    if not target:
+        #send_message(chat_id, "שימוש: השב על הודעת המשתמש, או /bl_add <user_id>")
+        return
+    if blacklist_add(ctx.chat_id, target):
+        send_message(ctx.chat_id, f" המשתמש לא יתוייג יותר")
+    else:
+        send_message(ctx.chat_id, "לא הצלחתי להוסיף ל-blacklist.")
+
+@command("bl_remove", "blacklist_remove", admin=True)
+def cmd_bl_remove(ctx: CommandContext):
+    target = resolve_target_user(ctx.msg, ctx.arg)
+    if not target:
+        send_message(ctx.chat_id, "שימוש: השב על הודעת המשתמש, או /bl_remove <user_id>")
+        return
+    if blacklist_remove(ctx.chat_id, target["id"]):
+        send_message(ctx.chat_id, f"הוסר")
+    #else: send_message(chat_id, "לא נמצא ב-blacklist.")
+
+@command("bl_list", admin=True, cooldown=10)
+def cmd_bl_list(ctx: CommandContext):
+    if not redis_call(lambda: r.hlen(_k_blacklist(ctx.chat_id)), default=0):
+        #send_message(chat_id, "ה-blacklist ריק.")
+        return
+    start_export(ctx.chat_id, "blacklist", *parse_export_args(ctx.arg))
+
+@command("all_users")
+def cmd_all_users(ctx: CommandContext):
+    chat_id = ctx.chat_id
+    if ctx.arg is None:
+        current = bool(get_setting(chat_id, "dotall_anyone", False))
+        who = "כולם" if current else "מנהלים בלבד"
+        send_message(chat_id, f"/dotall כרגע: {who}. לשינוי: /all_users on|off")
+        return
+    if not is_admin(chat_id, ctx.from_user.get("id", 0)):
+        send_message(chat_id, "רק מנהלים יכולים לשנות /all_users.")
+        return
+    arg = ctx.arg.strip().lower()
+    if arg in {"on", "off"}:
+        value = (arg == "on")
+        set_setting(chat_id, "dotall_anyone", value)
+        who = "כולם" if value else "מנהלים בלבד"
+        send_message(chat_id, f"הוגדר: /dotall זמין ל- {who}.")
+    else:
+        send_message(chat_id, "שימוש: /all_users on או /all_users off")
+
+@command("dotall")
+def cmd_dotall(ctx: CommandContext):
+    chat_id = ctx.chat_id
+    #if ctx.from_user.get("id", 0) == 919782824:
+    #   send_message(chat_id, "אני לא עובד אצלך מותק")
+    #   return
+    allow_all = bool(get_setting(chat_id, "dotall_anyone", False))
+    if not (allow_all or is_admin(chat_id, ctx.from_user.get("id", 0))):
+        send_message(chat_id, "הפקודה /dotall זמינה למנהלים בלבד. ניתן לשנות עם /all_users on")
+        return
+    if not scheduler.active(chat_id):
+        if not count_users(chat_id):
+            send_message(chat_id, "אין חברים ב-DB לתייג.")
+            return
+        if start_dotall(chat_id, ctx.from_user.get("id", 0)):
+            return
+    # כבר רץ (כאן או בעובד אחר): מצטרפים ל-job הקיים במקום להתחיל עוד אחד
+    progress = dotall_progress(chat_id)
+    if progress:
+        sent, total = progress
+        send_message(chat_id, f"הפקודה /dotall כבר רצה בקבוצה הזו ({sent}/{total}). לעצירה: /dotall_cancel")
+
+@command("dotall_cancel")
+def cmd_dotall_cancel(ctx: CommandContext):
+    chat_id, uid = ctx.chat_id, ctx.from_user.get("id", 0)
+    progress = dotall_progress(chat_id)
+    if not progress:
+        send_message(chat_id, "אין /dotall פעיל בקבוצה הזו.")
+        return
+    # מי שהפעיל יכול לעצור בעצמו; אחרת רק מנהלים
+    started_by = redis_call(lambda: r.hget(_k_job(chat_id), "started_by"), default=None)
+    if str(uid) != str(started_by) and not is_admin(chat_id, uid):
+        send_message(chat_id, "רק מנהלים או מי שהפעיל יכולים לעצור את /dotall.")
+        return
+    res = cancel_dotall(chat_id)
+    if res:
+        send_message(chat_id, f"/dotall נעצר אחרי {res[0]}/{res[1]}.")
+
+# ---------- טיפול בעדכון (משותף ל-webhook ול-workers) ----------
+def update_type(update: dict) -> str:
+    return next((k for k in update if k != "update_id"), "unknown")
+
+def handle_update(update: dict):
+    # מודד את כל הטיפול בעדכון; label הפקודה מגיע מ-_handle_update – בלי לפרסר את ההודעה שוב
+    started = time.perf_counter()
+    kind = update_type(update)
+    command_name = ""
+    try:
+        command_name = _handle_update(update) or ""
+    except Exception as e:
+        update_errors.inc(kind)
+        print("❌ webhook error:", repr(e))
+    update_latency.observe(time.perf_counter() - started, kind, command_name)
+
+def _handle_update(update: dict):
+    """מטפל בעדכון; מחזיר את שם הפקודה שנותבה (ל-label של המטריקה), או None."""
+    # ---- message / edited_message ----
+    msg = update.get("message") or update.get("edited_message")
+    if msg:
+        chat = msg.get("chat", {})
+        chat_id = chat.get("id")
+        chat_type = chat.get("type")
+        from_user = msg.get("from", {})
+        text = (msg.get("text") or "").strip()
+
+        # פרטי: /start /help
+        if chat_type == "private":
+            if text.startswith("/start") or text.startswith("/help"):
+                send_message(chat_id, HELP_TEXT)
+            else:
+                send_message(chat_id, "היי! כתוב /start כדי לראות את כל הפקודות הזמינות.")
+            return
+
+        # קבוצה: תחזוקת DB – השולח והמצטרפים בקריאה אחת (בוטים ו-blacklist מסוננים ב-upsert)
+        to_save = list(msg.get("new_chat_members") or [])
+        if chat_type in {"group", "supergroup"} and from_user.get("id"):
+            to_save.insert(0, from_user)
+        if to_save:
+            save_members(chat_id, to_save)
+
+        left = msg.get("left_chat_member")
+        if left and left.get("id"):
+            remove_user(chat_id, left["id"])
+
+        # ===== פקודות בקבוצה – ניתוב דרך COMMANDS =====
+        if chat_type in {"group", "supergroup"} and text:
+            parsed = parse_command(msg)
+            if parsed:
+                cmd, arg = parsed
+                dispatch_command(CommandContext(msg, chat_id, from_user, text, cmd, arg))
+                return COMMANDS[cmd].name
+        return
+
+    # ---- chat_member (join/leave/kick/promote) ----
+    chat_member_update = update.get("chat_member") or update.get("my_chat_member")
+    if chat_member_update:
+        chat = chat_member_update.get("chat", {})
+        chat_id = chat.get("id")
+        old = chat_member_update.get("old_chat_member", {})
+        new = chat_member_update.get("new_chat_member", {})
+        user = new.get("user") or old.get("user") or {}
+        new_status = (new.get("status") or "").lower()
+        old_status = (old.get("status") or "").lower()
+
+        # קידום/הורדה ממנהל – רשימת המנהלים ב-cache כבר לא נכונה
+        if (old_status in ADMIN_STATUSES) != (new_status in ADMIN_STATUSES):
+            invalidate_admins(chat_id)
+
+        if user.get("id"):
+            if new_status in {"member", "administrator", "creator"}:
+                add_user(chat_id, user)
+            elif new_status in {"left", "kicked", "restricted"}:
+                remove_user(chat_id, user["id"])
+
+        return
+
+# ---------- קליטת עדכונים: inline או תור עם workers ----------
+INGEST_MODE = os.getenv("INGEST_MODE", "inline")                    # inline | queue
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "4"))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "500"))      # לכל worker
+INGEST_PUT_TIMEOUT = float(os.getenv("INGEST_PUT_TIMEOUT", "0.5"))  # כמה לחכות למקום בתור לפני 503
+DEDUP_TTL = int(os.getenv("DEDUP_TTL", "3600"))                     # 0 = בלי סינון update_id כפולים
+
+def update_chat_id(update: dict):
+    msg = update.get("message") or update.get("edited_message") \
+        or update.get("chat_member") or update.get("my_chat_member") or {}
+    return (msg.get("chat") or {}).get("id")
+
+class UpdateQueue:
+    """
+    מאגר workers עם תור חסום לכל worker. צ'אט ממופה תמיד לאותו worker,
+    כך שעדכונים של אותו צ'אט מטופלים לפי הסדר; צ'אטים שונים רצים במקביל.
+    ה-threads עולים בעצלות (אחרי fork של gunicorn) ומתרוקנים ב-stop().
+    """
+    def __init__(self, workers: int, size: int, handler):
+        self.handler = handler
+        self.queues = [queue.Queue(maxsize=size) for _ in range(max(1, workers))]
+        self.threads = []
+        self._lock = threading.Lock()
+        self.stats = {"enqueued": 0, "rejected": 0, "duplicates": 0, "processed": 0}
+
+    def _start(self):
+        with self._lock:
+            if self.threads:
+                return
+            for q in self.queues:
+                t = threading.Thread(target=self._run, args=(q,), daemon=True)
+                t.start()
+                self.threads.append(t)
+
+    def _run(self, q):
+        while True:
+            update = q.get()
+            if update is None:
+                q.task_done()
+                return
+            try:
+                self.handler(update)
+            finally:
+                self.stats["processed"] += 1
+                q.task_done()
+
+    def submit(self, update: dict, timeout: float) -> bool:
+        if not self.threads:
+            self._start()
+        q = self.queues[hash(update_chat_id(update) or 0) % len(self.queues)]
+        try:
+            q.put(update, timeout=timeout)
+        except queue.Full:
+            self.stats["rejected"] += 1
+            return False
+        self.stats["enqueued"] += 1
+        return True
+
+    def stop(self, timeout: float = 10.0):
+        if not self.threads:
+            return
+        for q in self.queues:
+            q.put(None)
+        deadline = time.monotonic() + timeout
+        for t in self.threads:
+            t.join(max(0.0, deadline - time.monotonic()))
+
+    def snapshot(self) -> dict:
+        return dict(self.stats, depth=sum(q.qsize() for q in self.queues))
+
+_seen_updates = OrderedDict()
+_seen_lock = threading.Lock()
+
+def _k_update(update_id: int) -> str: return f"upd:{update_id}"  # String עם EXPIRE – update שכבר התקבל
+
+def is_duplicate_update(update_id) -> bool:
+    """
+    טלגרם שולח שוב עדכונים שלא אושרו בזמן. כאן רק הבדיקה בזיכרון – בלי רשת,
+    כי היא רצה ב-thread של בקשת ה-webhook. הבדיקה המשותפת ב-Redis נעשית ב-claim_update.
+    """
+    if not DEDUP_TTL or update_id is None:
+        return False
+    with _seen_lock:
+        if update_id in _seen_updates:
+            return True
+        _seen_updates[update_id] = None
+        if len(_seen_updates) > 10000:
+            _seen_updates.popitem(last=False)
+    return False
+
+def claim_update(update_id) -> bool:
+    """SET NX ב-Redis – משותף לכל ה-workers. אם Redis לא זמין – מטפלים בעדכון כרגיל."""
+    if not DEDUP_TTL or update_id is None:
+        return True
+    return bool(redis_call(lambda: r.set(_k_update(update_id), "1", nx=True, ex=DEDUP_TTL), default=True))
+
+def handle_new_update(update: dict) -> bool:
+    # רץ ב-worker של התור (או inline / polling): קודם בדיקת הכפילות ב-Redis, ורק אז הטיפול עצמו
+    if not claim_update(update.get("update_id")):
+        update_queue.stats["duplicates"] += 1
+        return False
+    handle_update(update)
+    return True
+
+def forget_update(update_id):
+    # עדכון שנדחה (503) יישלח שוב – אסור שייחשב כפול. ב-Redis הוא עוד לא סומן (זה קורה ב-worker)
+    if not DEDUP_TTL or update_id is None:
+        return
+    with _seen_lock:
+        _seen_updates.pop(update_id, None)
+
+update_queue = UpdateQueue(INGEST_WORKERS, INGEST_QUEUE_SIZE, handle_new_update)
+atexit.register(update_queue.stop)
+
+# ---------- Long polling (getUpdates) – חלופה ל-webhook ----------
+ALLOWED_UPDATES = ["message", "edited_message", "chat_member", "my_chat_member"]
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "50"))   # שניות שטלגרם מחזיק כל בקשה פתוחה
+POLL_LIMIT = int(os.getenv("POLL_LIMIT", "100"))       # עדכונים לבקשה (100 = המקסימום של טלגרם)
+_K_POLL_OFFSET = "bot:poll_offset"                     # String: ה-offset הבא ל-getUpdates
+
+def _needs_admins(update: dict) -> bool:
+    # רק פקודות שבודקות מנהל: admin=True, /dotall (אלא אם /all_users on) ושינוי של /all_users
+    msg = update.get("message") or update.get("edited_message") or {}
+    parsed = parse_command(msg)
+    if parsed is None:
+        return False
+    cmd, arg = parsed
+    spec = COMMANDS[cmd]
+    return spec.admin or spec.name == "dotall" or (spec.name == "all_users" and arg is not None)
+
+def process_batch(updates: list):
+    """
+    מטפל ב-batch של getUpdates עם אותם handlers של webhook(), לפי הסדר.
+    כל עדכון מסומן ב-Redis רק רגע לפני הטיפול בו, כך שאם התהליך נפל באמצע ה-batch
+    העדכונים שלא טופלו עוד יטופלו כשה-batch יגיע שוב. רשימת המנהלים נטענת פעם אחת לכל צ'אט
+    שיש בו פקודה שבודקת מנהל, וכתיבות החברים של כל ה-batch מתאחדות ב-buffer ונכתבות ב-flush אחד בסוף.
+    """
+    fresh = [u for u in updates if not is_duplicate_update(u.get("update_id"))]
+    for chat_id in {update_chat_id(u) for u in fresh if _needs_admins(u)} - {None}:
+        get_chat_admins(chat_id)
+    handled = sum(handle_new_update(update) for update in fresh)
+    member_buffer.flush()
+    return handled
+
+def run_polling():
+    start_background()  # warmup, reconcile וכו' – גם כשה-CLI רץ עם APP_FACTORY=1 (פעם אחת לתהליך)
+    # getUpdates לא עובד כשמוגדר webhook
+    api.get("deleteWebhook", timeout=10)
+    if not member_buffer.enabled:
+        # ב-polling ה-flush נעשה בסוף כל batch; הטיימר הוא רק גיבוי
+        member_buffer.interval = 60.0
+    offset = int(redis_call(lambda: r.get(_K_POLL_OFFSET), default=None) or 0)
+    print(f"📡 polling getUpdates from offset {offset}")
+    backoff = 1.0
+    while True:
+        try:
+            rsp = api.get("getUpdates", {
+                "offset": offset, "timeout": POLL_TIMEOUT, "limit": POLL_LIMIT,
+                "allowed_updates": json.dumps(ALLOWED_UPDATES),
+            }, timeout=POLL_TIMEOUT + 10)
+            if not rsp.ok:
+                print("getUpdates fail:", rsp.status_code, rsp.text)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+                continue
+            backoff = 1.0
+            updates = rsp.json().get("result", [])
+            if not updates:
+                continue
+            t0 = time.monotonic()
+            handled = process_batch(updates)
+            offset = updates[-1]["update_id"] + 1
+            redis_call(lambda: r.set(_K_POLL_OFFSET, offset))
+            print(f"📥 batch: {len(updates)} updates ({handled} new) in {time.monotonic() - t0:.2f}s")
+        except Exception as e:
+            print("❌ polling error:", repr(e))
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
 
 # ---------- Flask routes ----------
 @app.route("/")
@@ -255,217 +2192,86 @@ def index():
 
 @app.route(f"/{WEBHOOK_SECRET}", methods=["POST"])
 def webhook():
-    try:
-        update = request.get_json(silent=True) or {}
-
-        # ---- message / edited_message ----
-        msg = update.get("message") or update.get("edited_message")
-        if msg:
-            chat = msg.get("chat", {})
-            chat_id = chat.get("id")
-            chat_type = chat.get("type")
-            from_user = msg.get("from", {})
-            text = (msg.get("text") or "").strip()
-
-            # פרטי: /start /help
-            if chat_type == "private":
-                if text.startswith("/start") or text.startswith("/help"):
-                    send_message(chat_id, HELP_TEXT)
-                else:
-                    send_message(chat_id, "היי! כתוב /start כדי לראות את כל הפקודות הזמינות.")
-                return jsonify(ok=True)
-
-            # קבוצה: תחזוקת DB (לא לשמור בוטים)
-            if chat_type in {"group", "supergroup"} and from_user.get("id"):
-                if not from_user.get("is_bot"):
-                    if not is_blacklisted(chat_id, from_user["id"]):
-                        add_user(chat_id, from_user)
-
-            new_members = msg.get("new_chat_members") or []
-            for m in new_members:
-                if not (m.get("is_bot") or is_blacklisted(chat_id, m.get("id", 0))):
-                    add_user(chat_id, m)
-
-            left = msg.get("left_chat_member")
-            if left and left.get("id"):
-                remove_user(chat_id, left["id"])
-
-            # ===== פקודות בקבוצה – פרסינג נכון =====
-            if chat_type in {"group", "supergroup"} and text:
-                lower = text.strip().lower()
-
-                # חילוץ הפקודה כפי שטלגרם מסמן ב-entities
-                entities = msg.get("entities") or []
-                cmd = None
-                for e in entities:
-                    if e.get("type") == "bot_command":
-                        off = e.get("offset", 0)
-                        ln  = e.get("length", 0)
-                        cmd = (text[off:off+ln] or "").lower()
-                        break
-                if cmd:
-                    # מסירים @username אם נוסף (/count@mybot)
-                    cmd = cmd.split("@", 1)[0]
-
-                def is_cmd(name: str) -> bool:
-                    if cmd:
-                        return cmd == f"/{name}"
-                    # fallback אם משום מה אין entities
-                    return lower.startswith(f"/{name}")
-
-                # ---- פקודות ----
-                if is_cmd("whoami"):
-                    uid = from_user.get("id")
-                    isown = "✅" if (OWNER_ID and uid == OWNER_ID) else "❌"
-                    send_message(chat_id, f"ID: {uid}\nOwner: {isown}")
-                    return jsonify(ok=True)
-
-                if is_cmd("count"):
-                    send_message(chat_id, f"{count_users(chat_id)}")
-                    return jsonify(ok=True)
-
-                if is_cmd("export"):
-                    if not is_admin(chat_id, from_user.get("id", 0)):
-                        send_message(chat_id, "רק מנהלים יכולים להשתמש ב-/export.")
-                        return jsonify(ok=True)
-                    users = export_users(chat_id)
-                    if not users:
-                        send_message(chat_id, "אין נתונים.")
-                        return jsonify(ok=True)
-                    lines = []
-                    for u in users[:200]:
-                        name = (u.get("first_name") or "") + (" " + u.get("last_name") if u.get("last_name") else "")
-                        name = name.strip() or (u.get("username") or "unknown")
-                        lines.append(f"{name} — {u['id']}")
-                    send_message(chat_id, "Export (ראשונים):\n" + "\n".join(lines))
-                    return jsonify(ok=True)
-                    
-                
-                if is_cmd("bl_add") or is_cmd("blacklist_add"):
-                    if not is_admin(chat_id, from_user.get("id", 0)):
-                        send_message(chat_id, "רק מנהלים יכולים להשתמש ב-/bl_add.")
-                        return jsonify(ok=True)
-                    arg = text.split(maxsplit=1)[1] if " " in text else None
-                    target = resolve_target_user(msg, arg)
-                    if not target:
-                        #send_message(chat_id, "שימוש: השב על הודעת המשתמש, או /bl_add <user_id>")
-                        return jsonify(ok=True)
-                    if blacklist_add(chat_id, target):
-                        send_message(chat_id, f" המשתמש לא יתוייג יותר")
-                    else:
-                        send_message(chat_id, "לא הצלחתי להוסיף ל-blacklist.")
-                    return jsonify(ok=True)
-
-                if is_cmd("bl_remove") or is_cmd("blacklist_remove"):
-                    if not is_admin(chat_id, from_user.get("id", 0)):
-                        pass
-                        #send_message(chat_id, "רק מנהלים יכולים להשתמש ב-/bl_remove.")
-                        return jsonify(ok=True)
-                    arg = text.split(maxsplit=1)[1] if " " in text else None
-                    target = resolve_target_user(msg, arg)
-                    if not target:
-                        send_message(chat_id, "שימוש: השב על הודעת המשתמש, או /bl_remove <user_id>")
-                        return jsonify(ok=True)
-                    if blacklist_remove(chat_id, target["id"]):
-                        send_message(chat_id, f"הוסר")
-                    else:
-                        pass
-                        #send_message(chat_id, "לא נמצא ב-blacklist.")
-                    return jsonify(ok=True)
-
-                if is_cmd("bl_list"):
-                    if not is_admin(chat_id, from_user.get("id", 0)):
-                        pass
-                        #send_message(chat_id, "רק מנהלים יכולים להשתמש ב-/bl_list.")
-                        return jsonify(ok=True)
-                    bl = list_blacklist(chat_id)
-                    if not bl:
-                        pass
-                        #send_message(chat_id, "ה-blacklist ריק.")
-                        return jsonify(ok=True)
-                    lines = []
-                    for u in bl[:200]:
-                        name = (u.get("first_name") or "") + (" " + u.get("last_name") if u.get("last_name") else "")
-                        name = name.strip() or (u.get("username") or "unknown")
-                        lines.append(f"{name} — {u['id']}")
-                    send_message(chat_id, "Blacklist (ראשונים):\n" + "\n".join(lines))
-                    return jsonify(ok=True)
-
-                if is_cmd("all_users"):
-                    parts = text.split(maxsplit=1)
-                    if len(parts) == 1:
-                        current = bool(get_setting(chat_id, "dotall_anyone", False))
-                        who = "כולם" if current else "מנהלים בלבד"
-                        send_message(chat_id, f"/dotall כרגע: {who}. לשינוי: /all_users on|off")
-                        return jsonify(ok=True)
-                    if not is_admin(chat_id, from_user.get("id", 0)):
-                        send_message(chat_id, "רק מנהלים יכולים לשנות /all_users.")
-                        return jsonify(ok=True)
-                    arg = parts[1].strip().lower()
-                    if arg in {"on", "off"}:
-                        value = (arg == "on")
-                        set_setting(chat_id, "dotall_anyone", value)
-                        who = "כולם" if value else "מנהלים בלבד"
-                        send_message(chat_id, f"הוגדר: /dotall זמין ל- {who}.")
-                    else:
-                        send_message(chat_id, "שימוש: /all_users on או /all_users off")
-                    return jsonify(ok=True)
-
-                if is_cmd("dotall"):
-                    uid = from_user.get("id", 0)
-                    #if  uid == 919782824:
-                    #   send_message(chat_id, "אני לא עובד אצלך מותק")
-                     #  return jsonify(ok=True)
-                    allow_all = bool(get_setting(chat_id, "dotall_anyone", False))
-                    if not (is_admin(chat_id, from_user.get("id", 0)) or allow_all):
-                        send_message(chat_id, "הפקודה /dotall זמינה למנהלים בלבד. ניתן לשנות עם /all_users on")
-                        return jsonify(ok=True)
-                    ids = list_members_ids(chat_id)
-                    if not ids:
-                        send_message(chat_id, "אין חברים ב-DB לתייג.")
-                        return jsonify(ok=True)
-                    threading.Thread(target=run_dotall, args=(chat_id, ids), daemon=True).start()
-                    return jsonify(ok=True)
-
-            return jsonify(ok=True)
-
-        # ---- chat_member (join/leave/kick/promote) ----
-        chat_member_update = update.get("chat_member") or update.get("my_chat_member")
-        if chat_member_update:
-            chat = chat_member_update.get("chat", {})
-            chat_id = chat.get("id")
-            old = chat_member_update.get("old_chat_member", {})
-            new = chat_member_update.get("new_chat_member", {})
-            user = new.get("user") or old.get("user") or {}
-            new_status = (new.get("status") or "").lower()
-
-            if user.get("id"):
-                if new_status in {"member", "administrator", "creator"}:
-                    if not user.get("is_bot"):
-                        if not is_blacklisted(chat_id, user["id"]):
-                            add_user(chat_id, user)
-                elif new_status in {"left", "kicked", "restricted"}:
-                    remove_user(chat_id, user["id"])
-
-            return jsonify(ok=True)
-
+    update = request.get_json(silent=True) or {}
+    update_id = update.get("update_id")
+    if is_duplicate_update(update_id):
+        update_queue.stats["duplicates"] += 1
         return jsonify(ok=True)
-    except Exception as e:
-        # מחזירים 200 כדי לא לצבור pending ב-Telegram
-        print("❌ webhook error:", repr(e))
+
+    if INGEST_MODE == "queue":
+        if not update_queue.submit(update, INGEST_PUT_TIMEOUT):
+            # תור מלא – 503 גורם לטלגרם לנסות שוב מאוחר יותר (backpressure)
+            forget_update(update_id)
+            return jsonify(ok=False, error="busy"), 503
         return jsonify(ok=True)
 
+    # מחזירים 200 גם אם הטיפול נכשל, כדי לא לצבור pending ב-Telegram
+    handle_new_update(update)
+    return jsonify(ok=True)
+
+@app.route(f"/{WEBHOOK_SECRET}/stats")
+def stats():
+    return jsonify(admin_cache=admin_cache.snapshot(), ingest=update_queue.snapshot(),
+                   member_buffer=member_buffer.snapshot(), settings_cache=settings_cache.snapshot(),
+                   redis=dict(breaker=breaker.snapshot(), journal=journal.snapshot()),
+                   dotall=scheduler.snapshot(), reconcile=reconciler.snapshot(),
+                   commands=command_latency.snapshot())
+
+# ----- /metrics (פורמט טקסט של Prometheus) -----
+METRICS_MEMBERS_TTL = float(os.getenv("METRICS_MEMBERS_TTL", "60"))  # ספירת חברים לכל צ'אט מחושבת לכל היותר פעם בזה
+_member_counts = {"at": 0.0, "values": {}}
+_member_counts_lock = threading.Lock()
+
+def _collect_member_counts() -> dict:
+    """HLEN לכל chat:*:members ב-pipeline לכל דף של SCAN; נשמר בזיכרון METRICS_MEMBERS_TTL שניות."""
+    with _member_counts_lock:
+        if time.monotonic() - _member_counts["at"] < METRICS_MEMBERS_TTL:
+            return _member_counts["values"]
+        def _count():
+            values, keys = {}, list(iter_member_keys())
+            for i in range(0, len(keys), 500):
+                page = keys[i:i + 500]
+                pipe = r.pipeline(transaction=False)
+                for key in page:
+                    pipe.hlen(key)
+                for key, n in zip(page, pipe.execute()):
+                    values[(key.split(":")[1],)] = n
+            return values
+        values = redis_call(_count)
+        if values is not None:
+            _member_counts.update(at=time.monotonic(), values=values)
+        return _member_counts["values"]
+
+Gauge("bot_chat_members", "Stored members per chat (refreshed every METRICS_MEMBERS_TTL s)",
+      labels=("chat_id",), fn=_collect_member_counts)
+Gauge("bot_ingest_queue_depth", "Updates waiting in the ingest queue", fn=lambda: update_queue.snapshot()["depth"])
+Gauge("bot_member_buffer_pending", "Member writes waiting for the next flush",
+      fn=lambda: member_buffer.snapshot()["pending"])
+Gauge("redis_journal_pending_ops", "Member writes journaled while Redis is unavailable",
+      fn=lambda: journal.snapshot()["pending_ops"])
+Gauge("redis_journal_replay_lag_seconds", "Age of the oldest journaled member write still waiting for replay",
+      fn=lambda: journal.snapshot()["oldest_age_s"])
+Gauge("redis_breaker_open", "1 while the Redis circuit breaker is not closed",
+      fn=lambda: int(breaker.snapshot()["state"] != CircuitBreaker.CLOSED))
+Gauge("dotall_active_jobs", "/dotall jobs in progress", fn=lambda: len(scheduler.snapshot()["active"]))
+
+@app.route("/metrics")
+def metrics():
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return "unauthorized", 401
+    return REGISTRY.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
 # ----- רישום/מחיקת webhook -----
 @app.route("/setwebhook")
 def set_webhook():
     base = request.url_root.replace("http://", "https://")
     if not base.endswith("/"): base += "/"
     url = f"{base}{WEBHOOK_SECRET}"
-    rsp = requests.get(
-        f"{API}/setWebhook",
-        params={
+    rsp = api.get(
+        "setWebhook",
+        {
             "url": url,
-            "allowed_updates": json.dumps(["message","edited_message","chat_member","my_chat_member"])
+            "allowed_updates": json.dumps(ALLOWED_UPDATES)
         },
         timeout=10
     )
@@ -473,10 +2279,120 @@ def set_webhook():
 
 @app.route("/deletewebhook")
 def delete_webhook():
-    rsp = requests.get(f"{API}/deleteWebhook", timeout=10)
+    rsp = api.get("deleteWebhook", timeout=10)
     return rsp.text, rsp.status_code, {"Content-Type": "application/json"}
 
+# ----- פקודות תחזוקה: flask --app app <command> -----
+@app.cli.command("poll")
+def poll():
+    """Run the bot with getUpdates long polling instead of the webhook."""
+    run_polling()
+
+@app.cli.command("backfill-bots")
+def backfill_bots():
+    """Build chat:{id}:bots for chats stored before the bot index existed."""
+    chats = total = 0
+    for key in iter_member_keys():
+        chat_id = int(key.split(":")[1])
+        bots = []
+        for uid, raw in iter_hash(key):
+            try:
+                if (decode_member(uid, raw).get("username") or "").lower().endswith("bot"):
+                    bots.append(uid)
+            except Exception:
+                pass
+        if bots:
+            for i in range(0, len(bots), 1000):
+                redis_call(lambda: r.sadd(_k_bots(chat_id), *bots[i:i + 1000]))
+        chats += 1
+        total += len(bots)
+    print(f"✅ backfill-bots: {chats} chats, {total} bots indexed")
+
+@app.cli.command("migrate-members")
+def migrate_members():
+    """Convert stored members to MEMBER_FORMAT in place and build chat:{id}:ids."""
+    migrate_all_members()
+
+@app.cli.command("reconcile")
+@click.option("--chat", "chat_ids", type=int, multiple=True, help="Only these chats (default: all).")
+@click.option("--force", is_flag=True, help="Sweep even if the chat was reconciled within RECONCILE_INTERVAL.")
+def reconcile(chat_ids, force):
+    """Prune stored members who already left, using getChatMember under RECONCILE_RATE."""
+    for res in reconciler.run_once(list(chat_ids) or None, force=force):
+        print(res)
+
+# ---------- עלייה: app factory, warmup ו-readiness ----------
+# ה-import לא פונה לרשת: ה-pool של Redis וה-Session של Bot API נפתחים בעצלות, ו-warmup() ברקע
+# פותח את החיבורים הראשונים (כולל TLS) וטוען את סקריפטי ה-Lua. webhook שמגיע לפני כן פשוט
+# פותח חיבור בעצמו. /ready מדווח את המצב בלי לחכות; / נשאר בדיקת חיות בלבד.
+#   gunicorn 'app:create_app()'   עם APP_FACTORY=1 – ה-import נקי לגמרי מ-threads
+#   gunicorn app:app              כמו קודם – שירותי הרקע עולים ב-import
+APP_FACTORY = os.getenv("APP_FACTORY", "0") == "1"
+WARMUP_REDIS_CONNECTIONS = int(os.getenv("WARMUP_REDIS_CONNECTIONS", "2"))
+
+readiness = {"started": False, "done": False, "redis": False, "telegram": False, "warmup_s": None}
+_started_pid = None
+_start_lock = threading.Lock()
+
+def warmup():
+    """
+    חימום ראשון, ואם Redis לא ענה – ממשיך לנסות ברקע (עם backoff) עד שמצליח,
+    כך ש-/ready חוזר ל-ok גם כש-Redis עולה אחרי האפליקציה.
+    """
+    started = time.perf_counter()
+    def _redis():
+        # ping מקבילי פותח כמה חיבורים ב-pool; SCRIPT LOAD חוסך NOSCRIPT ב-EVALSHA הראשון
+        with ThreadPoolExecutor(max(1, WARMUP_REDIS_CONNECTIONS)) as ex:
+            list(ex.map(lambda _: r.ping(), range(max(1, WARMUP_REDIS_CONNECTIONS))))
+        pipe = r.pipeline(transaction=False)
+        for script in (_upsert_members, _dotall_page, _migrate_page, _dotall_acquire,
+                       _dotall_save, _dotall_release, _dotall_cancel, _lock_renew, _lock_release):
+            pipe.script_load(script.script)
+        pipe.execute()
+        return True
+    readiness["redis"] = bool(redis_call(_redis, default=False))
+    try:
+        readiness["telegram"] = api.get("getMe", timeout=10).ok  # חיבור keep-alive ראשון + בדיקת TOKEN
+    except Exception as e:
+        print("❌ Bot API warmup failed:", repr(e))
+    readiness.update(done=True, warmup_s=round(time.perf_counter() - started, 3))
+    print(f"{'✅' if readiness['redis'] else '❌'} warmup: redis={readiness['redis']} "
+          f"telegram={readiness['telegram']} in {readiness['warmup_s']}s")
+    backoff = 1.0
+    while not readiness["redis"]:
+        time.sleep(backoff)
+        backoff = min(backoff * 2, 30.0)
+        readiness["redis"] = bool(redis_call(_redis, default=False))
+        if readiness["redis"]:
+            print("✅ warmup: redis is back")
+
+def start_background() -> bool:
+    """מפעיל את warmup ואת background_tasks פעם אחת לכל תהליך (גם אחרי fork)."""
+    global _started_pid
+    with _start_lock:
+        if _started_pid == os.getpid():
+            return False
+        _started_pid = os.getpid()
+        readiness.update(started=True, done=False)
+    for target in [warmup] + background_tasks:
+        threading.Thread(target=target, daemon=True).start()
+    return True
+
+def create_app() -> Flask:
+    """app factory: מחזיר את ה-app מיד; החיבורים מתחממים ברקע."""
+    start_background()
+    return app
+
+@app.route("/ready")
+def ready():
+    # readiness probe: לא פונה ל-Redis/Telegram, רק מדווח מה ה-warmup מצא ומה מצב המפסק
+    ok = readiness["done"] and readiness["redis"] and not breaker.blocked()
+    return jsonify(ok=ok, breaker=breaker.snapshot()["state"], **readiness), (200 if ok else 503)
+
+if not APP_FACTORY:
+    start_background()
+
 # להרצה מקומית (לא חובה ב-Render)
 if __name__ == "__main__":
     port = int(os.getenv("PORT", "8000"))
-    app.run(host="0.0.0.0", port=port)
+    create_app().run(host="0.0.0.0", port=port)
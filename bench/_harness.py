@@ -0,0 +1,126 @@
+"""
+עזר משותף לבנצ'מרקים: מעלה את app.py מול fake Telegram מקומי ומול fakeredis
+(או Redis אמיתי עם redis_url), וסופר round-trips ל-Redis ברמת החיבור –
+כל send_packed_command הוא round-trip אחד, גם pipeline שלם וגם EVALSHA.
+"""
+import json, os, random, sys, threading
+import redis.connection
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+sys.path.insert(0, HERE)
+from fake_telegram import FakeTelegram  # noqa: E402
+
+
+class RoundTrips:
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+        orig = redis.connection.Connection.send_packed_command
+        counter = self
+
+        def send_packed_command(conn, *args, **kwargs):
+            with counter._lock:
+                counter.count += 1
+            return orig(conn, *args, **kwargs)
+
+        redis.connection.Connection.send_packed_command = send_packed_command
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+
+
+round_trips = RoundTrips()
+
+
+def load_app(redis_url: str | None = None, latency: float = 0.0, jitter: float = 0.0,
+             rate_429: float = 0.0, retry_after: int = 1, **env):
+    """
+    מחזיר (module app, FakeTelegram). בלי redis_url – fakeredis בתהליך (pip install 'fakeredis[lua]').
+    latency/jitter/rate_429/retry_after עוברים ל-FakeTelegram; שאר ה-kwargs נכנסים ל-env לפני ה-import.
+    """
+    srv = FakeTelegram(latency=latency, jitter=jitter, rate_429=rate_429, retry_after=retry_after, seed=1).start()
+    os.environ.update({
+        "TOKEN": "123456:BENCH",
+        "TG_API_BASE": srv.base_url,
+        "REDIS_URL": redis_url or "redis://127.0.0.1:1/0",
+    })
+    os.environ.setdefault("WEBHOOK_SECRET", "bench")
+    os.environ.setdefault("DOTALL_RESUME", "0")
+    os.environ.setdefault("APP_FACTORY", "1")  # שירותי הרקע עולים רק אחרי שה-Redis הוחלף
+    os.environ.update({k: str(v) for k, v in env.items()})
+
+    import app
+    if redis_url is None:
+        import fakeredis
+        fake = fakeredis.FakeRedis(decode_responses=True)
+        app.r = fake
+        app.new_client = lambda: fake
+    app.breaker.reset()  # עם APP_FACTORY=0 ה-warmup כבר רץ מול הכתובת המדומה – הכשלים שלו לא נחשבים
+    app.create_app()
+    return app, srv
+
+
+BENCH_COMMANDS = ("/count", "/whoami", "/all_users")  # פקודות שלא דורשות מנהל ולא מתחילות /dotall
+
+
+def synthetic_updates(n: int, chat_id: int = -100, users: int = 300, seed: int = 1, commands: float = 0.0):
+    """
+    זרם עדכונים סינתטי: בעיקר הודעות ממאגר משתמשים קבוע, וגם הצטרפויות, עזיבות ו-chat_member.
+    commands – החלק מההודעות שהן פקודות (מתוך BENCH_COMMANDS).
+    """
+    rnd = random.Random(seed)
+    chat = {"id": chat_id, "type": "supergroup"}
+
+    def user(uid):
+        return {"id": uid, "is_bot": False, "first_name": f"user{uid}", "username": f"u{uid}"}
+
+    for i in range(1, n + 1):
+        roll = rnd.random()
+        uid = rnd.randint(1, users)
+        if roll < 0.80 * commands:
+            text = rnd.choice(BENCH_COMMANDS)
+            upd = {"message": {"message_id": i, "chat": chat, "from": user(uid), "text": text,
+                               "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}]}}
+        elif roll < 0.80:
+            upd = {"message": {"message_id": i, "chat": chat, "from": user(uid), "text": "hello"}}
+        elif roll < 0.90:
+            joined = [user(users + rnd.randint(1, users)) for _ in range(rnd.randint(1, 3))]
+            upd = {"message": {"message_id": i, "chat": chat, "from": joined[0], "new_chat_members": joined}}
+        elif roll < 0.95:
+            upd = {"message": {"message_id": i, "chat": chat, "from": user(uid), "left_chat_member": user(uid)}}
+        else:
+            upd = {"chat_member": {"chat": chat, "from": user(uid),
+                                   "old_chat_member": {"status": "left", "user": user(uid)},
+                                   "new_chat_member": {"status": "member", "user": user(uid)}}}
+        upd["update_id"] = i
+        yield upd
+
+
+def load_updates(path: str):
+    """
+    זרם מוקלט: JSONL של עדכונים, מערך JSON, או תשובת getUpdates שמורה ({"result": [...]}).
+    update_id ממוספר מחדש כדי שה-dedup לא יבלע הרצות חוזרות.
+    """
+    with open(path, encoding="utf-8") as f:
+        text = f.read().strip()
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:  # יותר מאובייקט אחד – JSONL
+        data = [json.loads(line) for line in text.splitlines() if line.strip()]
+    if isinstance(data, dict):
+        data = data["result"] if "result" in data else [data]
+    updates = data
+    for i, upd in enumerate(updates, 1):
+        yield dict(upd, update_id=i)
+
+
+def percentiles(samples, qs=(50, 90, 99)) -> dict:
+    """אחוזונים (nearest-rank) במילישניות, ועוד max."""
+    if not samples:
+        return {f"p{q}": 0.0 for q in qs} | {"max": 0.0}
+    xs = sorted(samples)
+    out = {f"p{q}": round(xs[min(len(xs) - 1, max(0, -(-q * len(xs) // 100) - 1))] * 1000, 3) for q in qs}
+    out["max"] = round(xs[-1] * 1000, 3)
+    return out
@@ -0,0 +1,67 @@
+"""
+בנצ'מרק: requests.post לכל קריאה (חיבור חדש בכל פעם) מול BotAPI עם Session משותף,
+ואם aiohttp מותקן – גם מול AsyncBotAPI. הכל מול bench/fake_telegram.py המקומי.
+
+    python bench/bench_botapi.py --calls 500 --latency 0.002
+"""
+import argparse, asyncio, os, sys, time
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from botapi import BotAPI, AsyncBotAPI, load_aiohttp  # noqa: E402
+from fake_telegram import FakeTelegram           # noqa: E402
+
+TOKEN = "123456:BENCH"
+
+
+def run_per_call(base, n):
+    for i in range(n):
+        requests.post(f"{base}/bot{TOKEN}/sendMessage", json={"chat_id": 1, "text": str(i)}, timeout=20)
+
+
+def run_pooled(base, n):
+    api = BotAPI(TOKEN, base=base)
+    for i in range(n):
+        api.post("sendMessage", {"chat_id": 1, "text": str(i)})
+    api.close()
+
+
+def run_async(base, n, concurrency):
+    async def main():
+        async with AsyncBotAPI(TOKEN, base=base, pool_size=concurrency) as aapi:
+            sem = asyncio.Semaphore(concurrency)
+
+            async def one(i):
+                async with sem:
+                    await aapi.post("sendMessage", {"chat_id": 1, "text": str(i)})
+
+            await asyncio.gather(*(one(i) for i in range(n)))
+    asyncio.run(main())
+
+
+def measure(srv, name, fn, n):
+    srv.stats.reset()
+    t0 = time.perf_counter()
+    fn()
+    dt = time.perf_counter() - t0
+    s = srv.stats.snapshot()
+    print(f"{name:<10} calls={n:<6} connections={s['connections']:<6} "
+          f"total={dt:.3f}s  per_call={dt / n * 1000:.2f}ms")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--calls", type=int, default=300)
+    ap.add_argument("--latency", type=float, default=0.0)
+    ap.add_argument("--concurrency", type=int, default=10, help="async backend only")
+    args = ap.parse_args()
+
+    srv = FakeTelegram(latency=args.latency).start()
+    base = srv.base_url
+    measure(srv, "per-call", lambda: run_per_call(base, args.calls), args.calls)
+    measure(srv, "pooled", lambda: run_pooled(base, args.calls), args.calls)
+    if load_aiohttp() is not None:
+        measure(srv, "async", lambda: run_async(base, args.calls, args.concurrency), args.calls)
+    else:
+        print("async      skipped (aiohttp not installed)")
+    srv.stop()
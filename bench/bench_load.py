@@ -0,0 +1,216 @@
+"""
+בדיקת עומס מקצה לקצה, בלי רשת ובלי Upstash: app.py מול fake Telegram מקומי (עם latency ו-429
+לפי בחירה) ומול fakeredis, או Redis מקומי עם --redis-url. שלושה תרחישים:
+
+  webhook – שידור חוזר של זרם עדכונים (סינתטי, או מוקלט עם --replay) ל-POST /<secret>
+            בקצב --rate (0 = מהר ככל האפשר) ועם --concurrency בקשות במקביל
+  add_user – קריאות ישירות ל-add_user, כולל ה-flush של ה-buffer בסוף
+  dotall  – /dotall מלא על --members חברים, עד שה-job מסתיים
+
+לכל תרחיש: throughput, אחוזוני latency, ו-round-trips ל-Redis וקריאות HTTP ל-Bot API לכל פעולה.
+עם rate, ה-latency נמדדת מהזמן המתוכנן של הבקשה – אם האפליקציה מפגרת, ההמתנה נספרת.
+
+    python bench/bench_load.py --updates 5000 --commands 0.05
+    python bench/bench_load.py --scenarios webhook --rate 500 --concurrency 8 --latency 0.02 --rate-429 0.05
+    python bench/bench_load.py --replay updates.jsonl --json out.json
+    python bench/bench_load.py --baseline out.json --tolerance 0.25   # exit 1 על רגרסיה
+"""
+import argparse, contextlib, io, json, sys, threading, time
+from _harness import load_app, load_updates, percentiles, round_trips, synthetic_updates
+
+CHAT_ID = -100
+
+
+class Counters:
+    """round-trips ל-Redis ובקשות ל-fake Telegram בין start() ל-stop()."""
+
+    def __init__(self, srv):
+        self.srv = srv
+
+    def start(self):
+        round_trips.reset()
+        self.srv.stats.reset()
+        self.t0 = time.perf_counter()
+
+    def stop(self, ops: int) -> dict:
+        elapsed = time.perf_counter() - self.t0
+        tg = self.srv.stats.snapshot()
+        return {
+            "ops": ops,
+            "seconds": round(elapsed, 3),
+            "ops_per_s": round(ops / elapsed, 1) if elapsed else 0.0,
+            "redis_per_op": round(round_trips.count / ops, 3) if ops else 0.0,
+            "http_per_op": round(tg["requests"] / ops, 3) if ops else 0.0,
+            "http_429": tg["throttled"],
+        }
+
+
+def replay(app, updates: list, rate: float, concurrency: int) -> list:
+    """שולח את העדכונים ל-webhook; מחזיר latency לכל בקשה (שניות)."""
+    url = f"/{app.WEBHOOK_SECRET}"
+    latencies = [0.0] * len(updates)
+    next_i = iter(range(len(updates)))
+    lock = threading.Lock()
+    t0 = time.perf_counter()
+
+    def worker():
+        client = app.app.test_client()
+        while True:
+            with lock:
+                i = next(next_i, None)
+            if i is None:
+                return
+            due = t0 + i / rate if rate else None
+            if due is not None:
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            started = due if due is not None else time.perf_counter()
+            rsp = client.post(url, json=updates[i])
+            latencies[i] = time.perf_counter() - started
+            if rsp.status_code != 200:
+                print(f"webhook returned {rsp.status_code} for update {updates[i]['update_id']}", file=sys.stderr)
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, concurrency))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies
+
+
+def run_webhook(app, srv, updates, args) -> dict:
+    counters = Counters(srv)
+    counters.start()
+    latencies = replay(app, updates, args.rate, args.concurrency)
+    for q in app.update_queue.queues:  # INGEST_MODE=queue: מחכים שה-workers יסיימו
+        q.join()
+    app.member_buffer.flush()
+    return dict(counters.stop(len(updates)), **percentiles(latencies))
+
+
+def run_add_user(app, srv, args) -> dict:
+    n = args.updates
+    users = [{"id": 10_000_000 + i, "is_bot": False, "first_name": f"load{i}", "username": f"load{i}"}
+             for i in range(n)]
+    latencies = []
+    counters = Counters(srv)
+    counters.start()
+    for u in users:
+        t = time.perf_counter()
+        app.add_user(CHAT_ID - 1, u)
+        latencies.append(time.perf_counter() - t)
+    t = time.perf_counter()
+    app.member_buffer.flush()
+    flush_ms = round((time.perf_counter() - t) * 1000, 3)
+    return dict(counters.stop(n), flush_ms=flush_ms, **percentiles(latencies))
+
+
+def run_dotall(app, srv, args) -> dict:
+    chat_id = CHAT_ID - 2
+    users = [{"id": 20_000_000 + i, "is_bot": False, "first_name": f"m{i}", "username": f"m{i}"}
+             for i in range(args.members)]
+    for i in range(0, len(users), 500):
+        app.upsert_members(chat_id, users[i:i + 500])
+    before = dict(app.scheduler.snapshot())
+    counters = Counters(srv)
+    counters.start()
+    if not app.start_dotall(chat_id):
+        raise SystemExit("start_dotall failed")
+    deadline = time.monotonic() + args.dotall_timeout
+    while app.scheduler.active(chat_id):
+        if time.monotonic() > deadline:
+            raise SystemExit(f"/dotall did not finish within {args.dotall_timeout}s")
+        time.sleep(0.01)
+    after = app.scheduler.snapshot()
+    messages = after["messages_sent"] - before["messages_sent"]
+    res = counters.stop(max(messages, 1))
+    res.update(mentions=after["mentions_sent"] - before["mentions_sent"],
+               retries_429=after["retries_429"] - before["retries_429"],
+               mentions_per_s=after["last_job"]["mentions_per_s"])
+    return res
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """מחזיר שורות רגרסיה: p99 ו-ops/s עם סובלנות יחסית, round-trips ו-HTTP לכל פעולה בכל עלייה."""
+    problems = []
+    for name, cur in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if "p99" in base and cur.get("p99", 0) > base["p99"] * (1 + tolerance):
+            problems.append(f"{name}: p99 {base['p99']}ms -> {cur['p99']}ms")
+        if base.get("ops_per_s") and cur["ops_per_s"] < base["ops_per_s"] * (1 - tolerance):
+            problems.append(f"{name}: ops/s {base['ops_per_s']} -> {cur['ops_per_s']}")
+        for key in ("redis_per_op", "http_per_op"):
+            if cur[key] > base[key] + 0.01:
+                problems.append(f"{name}: {key} {base[key]} -> {cur[key]}")
+    return problems
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Offline load test for app.py")
+    ap.add_argument("--scenarios", default="webhook,add_user,dotall")
+    ap.add_argument("--updates", type=int, default=3000, help="synthetic updates / add_user calls")
+    ap.add_argument("--replay", default=None, help="recorded updates (JSONL, JSON array or getUpdates dump)")
+    ap.add_argument("--commands", type=float, default=0.05, help="share of synthetic messages that are commands")
+    ap.add_argument("--users", type=int, default=300, help="distinct senders in the synthetic stream")
+    ap.add_argument("--rate", type=float, default=0.0, help="updates per second (0 = as fast as possible)")
+    ap.add_argument("--concurrency", type=int, default=4)
+    ap.add_argument("--members", type=int, default=5000, help="members tagged by the dotall scenario")
+    ap.add_argument("--dotall-timeout", type=float, default=120)
+    ap.add_argument("--latency", type=float, default=0.0, help="fake Telegram latency per call (s)")
+    ap.add_argument("--jitter", type=float, default=0.0)
+    ap.add_argument("--rate-429", type=float, default=0.0, help="probability of a 429 on sendMessage")
+    ap.add_argument("--retry-after", type=int, default=1)
+    ap.add_argument("--redis-url", default=None, help="local Redis instead of fakeredis (use a scratch db)")
+    ap.add_argument("--env", action="append", default=[], help="extra app env, e.g. --env INGEST_MODE=queue")
+    ap.add_argument("--json", default=None, help="write results to this file")
+    ap.add_argument("--baseline", default=None, help="compare with a previous --json file")
+    ap.add_argument("--tolerance", type=float, default=0.25)
+    ap.add_argument("--verbose", action="store_true", help="keep the app's own prints")
+    args = ap.parse_args()
+
+    env = {
+        # המתזמן של /dotall לא אמור להיות צוואר הבקבוק בבנצ'מרק – ה-429 מה-fake הם שמגבילים
+        "DOTALL_CHAT_RATE_PER_MIN": "600000", "DOTALL_CHAT_BURST": "1000", "DOTALL_GLOBAL_RATE": "100000",
+        "WEBHOOK_SECRET": "bench",
+    }
+    env.update(a.split("=", 1) for a in args.env)
+    app, srv = load_app(args.redis_url, latency=args.latency, jitter=args.jitter,
+                        rate_429=args.rate_429, retry_after=args.retry_after, **env)
+    if args.replay:
+        updates = list(load_updates(args.replay))
+    else:
+        updates = list(synthetic_updates(args.updates, CHAT_ID, users=args.users, commands=args.commands))
+
+    results = {}
+    for name in [s.strip() for s in args.scenarios.split(",") if s.strip()]:
+        with contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO()):
+            if name == "webhook":
+                results[name] = run_webhook(app, srv, updates, args)
+            elif name == "add_user":
+                results[name] = run_add_user(app, srv, args)
+            elif name == "dotall":
+                results[name] = run_dotall(app, srv, args)
+            else:
+                raise SystemExit(f"unknown scenario: {name}")
+        res = results[name]
+        print(f"{name:<9} ops={res['ops']:<6} {res['ops_per_s']:>9.1f}/s  "
+              f"p50={res['p50']:.3f}ms p90={res['p90']:.3f}ms p99={res['p99']:.3f}ms max={res['max']:.2f}ms  "
+              f"redis/op={res['redis_per_op']:.2f} http/op={res['http_per_op']:.2f} 429s={res['http_429']}"
+              if "p50" in res else
+              f"{name:<9} messages={res['ops']:<5} {res['seconds']:.2f}s  mentions={res['mentions']} "
+              f"({res['mentions_per_s']:.0f}/s)  redis/msg={res['redis_per_op']:.2f} "
+              f"http/msg={res['http_per_op']:.2f} 429s={res['http_429']} retries={res['retries_429']}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = compare(results, json.load(f), args.tolerance)
+        for p in problems:
+            print("REGRESSION", p)
+        if problems:
+            sys.exit(1)
@@ -0,0 +1,74 @@
+"""
+כמה round-trips ל-Redis עולה כל עדכון: המסלול הישן (is_blacklisted פעמיים + hset לכל משתמש)
+מול upsert_members (EVALSHA אחד להודעה, כולל new_chat_members), ומול ה-write-behind buffer
+(pipeline אחד לכל flush; MEMBER_FLUSH_INTERVAL=0 מכבה אותו).
+
+    python bench/bench_roundtrips.py --updates 2000
+    python bench/bench_roundtrips.py --redis-url redis://127.0.0.1:6379/15
+"""
+import argparse, json, time
+from _harness import load_app, round_trips, synthetic_updates
+
+
+def legacy_handle(app, r, update):
+    # שחזור של תחזוקת ה-DB לפני השינוי, כדי שיהיה מול מה להשוות
+    def blacklisted(chat_id, uid):
+        return r.hexists(app._k_blacklist(chat_id), str(uid))
+
+    def add(chat_id, u):
+        if u.get("is_bot") or blacklisted(chat_id, u["id"]):
+            return
+        slim = {"id": u["id"], "first_name": u.get("first_name"), "last_name": u.get("last_name"),
+                "username": u.get("username"), "added_at": int(time.time())}
+        r.hset(app._k_members(chat_id), str(u["id"]), json.dumps(slim, ensure_ascii=False))
+
+    msg = update.get("message")
+    if msg:
+        chat_id = msg["chat"]["id"]
+        frm = msg.get("from") or {}
+        if frm.get("id") and not frm.get("is_bot") and not blacklisted(chat_id, frm["id"]):
+            add(chat_id, frm)
+        for m in msg.get("new_chat_members") or []:
+            if not (m.get("is_bot") or blacklisted(chat_id, m["id"])):
+                add(chat_id, m)
+        left = msg.get("left_chat_member")
+        if left:
+            r.hdel(app._k_members(chat_id), str(left["id"]))
+        return
+    cm = update["chat_member"]
+    u = cm["new_chat_member"]["user"]
+    if not blacklisted(cm["chat"]["id"], u["id"]):
+        add(cm["chat"]["id"], u)
+
+
+def run(name, fn, updates, after=None):
+    round_trips.reset()
+    t0 = time.perf_counter()
+    for upd in updates:
+        fn(upd)
+    if after:
+        after()
+    dt = time.perf_counter() - t0
+    n = len(updates)
+    print(f"{name:<8} updates={n}  round_trips={round_trips.count}  per_update={round_trips.count / n:.2f}  "
+          f"time={dt:.2f}s")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--updates", type=int, default=2000)
+    ap.add_argument("--redis-url", default=None, help="real Redis instead of fakeredis (uses a scratch chat id)")
+    args = ap.parse_args()
+
+    app, srv = load_app(args.redis_url)
+    updates = list(synthetic_updates(args.updates))
+    app.r.delete(app._k_members(-100))
+    run("before", lambda u: legacy_handle(app, app.r, u), updates)
+    app.r.delete(app._k_members(-100))
+    buffered, app.member_buffer.interval = app.member_buffer.interval, 0
+    run("upsert", app.handle_update, updates)
+    app.r.delete(app._k_members(-100))
+    app.member_buffer.interval = buffered or 2.0
+    run("buffered", app.handle_update, updates, after=app.member_buffer.flush)
+    print("buffer:", app.member_buffer.snapshot())
+    srv.stop()
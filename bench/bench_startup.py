@@ -0,0 +1,86 @@
+"""
+זמן עלייה של worker: כמה זמן מהפעלת התהליך עד שה-import של app.py מסתיים, עד שה-webhook
+הראשון נענה ועד ש-/ready מחזיר 200. כל הרצה היא תהליך Python חדש (cold start), מול
+bench/fake_telegram.py ו-fakeredis – או Redis אמיתי עם --redis-url.
+
+    python bench/bench_startup.py --runs 5
+    python bench/bench_startup.py --mode factory --redis-url redis://127.0.0.1:6379/15
+"""
+import argparse, json, os, statistics, subprocess, sys, time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def child(redis_url: str | None):
+    # רץ בתהליך החדש; T0 הוא הרגע שבו ההורה הפעיל אותו
+    t0 = float(os.environ["BENCH_T0"])
+    sys.path.insert(0, os.path.join(HERE, ".."))
+    sys.path.insert(0, HERE)
+    from fake_telegram import FakeTelegram
+    if redis_url is None:
+        import fakeredis  # לא נספר ב-import של app
+    srv = FakeTelegram().start()
+    os.environ.update({"TOKEN": "123456:BENCH", "TG_API_BASE": srv.base_url, "WEBHOOK_SECRET": "bench",
+                       "REDIS_URL": redis_url or "redis://127.0.0.1:1/0", "DOTALL_RESUME": "0"})
+    t_main = time.time()
+    import app
+    t_import = time.time()
+    if redis_url is None:
+        fake = fakeredis.FakeRedis(decode_responses=True)
+        app.r = fake
+        app.breaker.reset()
+    flask_app = app.create_app()
+    t_app = time.time()
+    client = flask_app.test_client()
+    update = {"update_id": 1, "message": {"message_id": 1, "chat": {"id": -1, "type": "supergroup"},
+                                          "from": {"id": 7, "first_name": "a"}, "text": "hello"}}
+    assert client.post("/bench", json=update).status_code == 200
+    t_first = time.time()
+    deadline = t_first + 15
+    while client.get("/ready").status_code != 200 and time.time() < deadline:
+        time.sleep(0.005)
+    t_ready = time.time()
+    ms = lambda t: round((t - t0) * 1000, 1)
+    print(json.dumps({"interpreter": ms(t_main), "import": round((t_import - t_main) * 1000, 1),
+                      "imported": ms(t_import), "create_app": ms(t_app), "first_webhook": ms(t_first),
+                      "ready": ms(t_ready), "ready_ok": client.get("/ready").status_code == 200}))
+
+
+def run(mode: str, runs: int, redis_url: str | None) -> dict:
+    samples = []
+    env = dict(os.environ, APP_FACTORY="1" if mode == "factory" else "0")
+    args = [sys.executable, os.path.abspath(__file__), "--child"] + (["--redis-url", redis_url] if redis_url else [])
+    for _ in range(runs):
+        env["BENCH_T0"] = repr(time.time())
+        out = subprocess.run(args, env=env, capture_output=True, text=True, timeout=60)
+        line = [l for l in out.stdout.splitlines() if l.startswith("{")]
+        if not line:
+            raise SystemExit(out.stdout + out.stderr)
+        samples.append(json.loads(line[-1]))
+    keys = ("interpreter", "import", "first_webhook", "ready")
+    return {k: {"median": statistics.median(s[k] for s in samples), "min": min(s[k] for s in samples),
+                "max": max(s[k] for s in samples)} for k in keys} | {
+        "ready_ok": all(s["ready_ok"] for s in samples)}
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Cold-start time of app.py")
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("--mode", choices=("factory", "legacy", "both"), default="both",
+                    help="factory: APP_FACTORY=1 + create_app(); legacy: background threads start on import")
+    ap.add_argument("--redis-url", default=None)
+    ap.add_argument("--json", default=None, help="write results to this file")
+    ap.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+    if args.child:
+        child(args.redis_url)
+        sys.exit(0)
+    results = {}
+    for mode in (("factory", "legacy") if args.mode == "both" else (args.mode,)):
+        res = results[mode] = run(mode, args.runs, args.redis_url)
+        print(f"{mode:<8} " + "  ".join(f"{k}={v['median']:.0f}ms" for k, v in res.items() if isinstance(v, dict))
+              + f"  (median of {args.runs}, ms from process start; import = app.py alone)"
+              + ("" if res["ready_ok"] else "  NOT READY"))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
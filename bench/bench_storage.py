@@ -0,0 +1,70 @@
+"""
+זיכרון ב-Redis וזמן פענוח לכל פורמט שמירה של חברים (json מול packed), ב-10k/100k/1M חברים.
+ב-Redis אמיתי הזיכרון נמדד ב-MEMORY USAGE; ב-fakeredis מוצג סכום הבייטים של field+value (הערכה).
+
+    python bench/bench_storage.py --sizes 10000,100000
+    python bench/bench_storage.py --sizes 10000,100000,1000000 --redis-url redis://127.0.0.1:6379/15
+"""
+import argparse, random, time
+from _harness import load_app
+
+CHAT_ID = -424242
+
+
+def fake_profile(rnd, uid):
+    first = rnd.choice(["דני", "Noa", "יוסי", "Maya", "אבי", "Lior", "שירה", "Omer"])
+    last = rnd.choice([None, "Cohen", "לוי", "Mizrahi"])
+    username = rnd.choice([None, f"user_{uid}", f"{first.lower()}{uid % 1000}"])
+    return {"id": uid, "first_name": first, "last_name": last, "username": username,
+            "added_at": 1700000000 + uid}
+
+
+def fill(app, r, codec, n):
+    key = app._k_members(CHAT_ID)
+    r.delete(key, app._k_ids(CHAT_ID))
+    rnd = random.Random(n)
+    pipe = r.pipeline(transaction=False)
+    for uid in range(1, n + 1):
+        pipe.hset(key, str(uid), codec.encode(fake_profile(rnd, uid)))
+        if codec is app.MEMBER_CODECS["packed"]:
+            pipe.sadd(app._k_ids(CHAT_ID), uid)
+        if uid % 5000 == 0:
+            pipe.execute()
+    pipe.execute()
+
+
+def memory(app, r, real):
+    keys = [app._k_members(CHAT_ID), app._k_ids(CHAT_ID)]
+    if real:
+        return sum(r.memory_usage(k, samples=0) or 0 for k in keys), ""
+    total = 0
+    for field, value in app.iter_hash(keys[0]):
+        total += len(field.encode()) + len(value.encode())
+    return total, " (approx, hash only)"
+
+
+def decode_time(app, r):
+    values = list(app.iter_hash(app._k_members(CHAT_ID), count=5000))
+    t0 = time.perf_counter()
+    for uid, raw in values:
+        app.decode_member(uid, raw)
+    return time.perf_counter() - t0
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", default="10000,100000")
+    ap.add_argument("--redis-url", default=None)
+    args = ap.parse_args()
+
+    app, srv = load_app(args.redis_url)
+    r = app.r
+    for n in [int(x) for x in args.sizes.split(",")]:
+        for fmt in ("json", "packed"):
+            fill(app, r, app.MEMBER_CODECS[fmt], n)
+            mem, note = memory(app, r, args.redis_url is not None)
+            dt = decode_time(app, r)
+            print(f"n={n:<8} format={fmt:<7} memory={mem / 1024 / 1024:8.2f}MB{note}  "
+                  f"bytes/member={mem / n:6.1f}  decode={dt:.3f}s ({dt / n * 1e6:.2f}us/member)")
+    r.delete(app._k_members(CHAT_ID), app._k_ids(CHAT_ID))
+    srv.stop()
@@ -0,0 +1,150 @@
+"""
+שרת Bot API מזויף ומקומי לבנצ'מרקים: עונה על /bot<token>/<method> בתשובות קבועות,
+שומר חיבורים פתוחים (HTTP/1.1 keep-alive) וסופר כמה חיבורי TCP נפתחו וכמה בקשות הגיעו.
+אפשר להוסיף השהייה (latency + jitter אקראי) ולהחזיר 429 עם retry_after בהסתברות נתונה
+לשיטות שנבחרו (ברירת מחדל sendMessage) – כמו flood control של טלגרם.
+
+הרצה עצמאית:  python bench/fake_telegram.py --port 8081 --latency 0.05 --rate-429 0.02
+ואז:          TG_API_BASE=http://127.0.0.1:8081 python app.py
+"""
+import argparse, json, random, socket, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+        self.throttled = 0
+        self.by_method = {}
+
+    def snapshot(self):
+        with self.lock:
+            return {"connections": self.connections, "requests": self.requests, "throttled": self.throttled,
+                    "by_method": dict(self.by_method)}
+
+    def reset(self):
+        with self.lock:
+            self.connections = 0
+            self.requests = 0
+            self.throttled = 0
+            self.by_method = {}
+
+
+def _result_for(method: str, server, params: dict):
+    if method == "sendMessage":
+        server.message_id += 1
+        return {"message_id": server.message_id, "date": int(time.time())}
+    if method == "getChatMember":
+        # server.left: מזהים שנחשבים כמי שעזבו (לבנצ'מרק של ה-reconciliation)
+        uid = int(params.get("user_id") or 0)
+        status = "left" if uid in server.left else "member"
+        return {"status": status, "user": {"id": uid, "is_bot": False, "first_name": "fake"}}
+    if method == "getChatAdministrators":
+        return []
+    if method == "getMe":
+        return {"id": 1, "is_bot": True, "first_name": "fake", "username": "fake_bot"}
+    if method == "getUpdates":
+        return []
+    return True
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # בלי זה כל תשובה סוגרת את החיבור
+
+    def setup(self):
+        super().setup()
+        # כותרות וגוף נכתבים בנפרד – בלי NODELAY ה-delayed ACK מוסיף ~40ms לכל בקשה על חיבור חוזר
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.server.stats.lock:
+            self.server.stats.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def _handle(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        url = urlparse(self.path)
+        method = url.path.rsplit("/", 1)[-1]
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if raw and self.headers.get("Content-Type", "").startswith("application/json"):
+            try:
+                params.update(json.loads(raw))
+            except ValueError:
+                pass
+        server, stats = self.server, self.server.stats
+        throttle = method in server.throttle_methods and server.rate_429 and server.rnd.random() < server.rate_429
+        with stats.lock:
+            stats.requests += 1
+            stats.by_method[method] = stats.by_method.get(method, 0) + 1
+            if throttle:
+                stats.throttled += 1
+        delay = server.latency + (server.rnd.uniform(0, server.jitter) if server.jitter else 0.0)
+        if delay:
+            time.sleep(delay)
+        if throttle:
+            status = 429
+            body = json.dumps({"ok": False, "error_code": 429,
+                               "description": f"Too Many Requests: retry after {server.retry_after}",
+                               "parameters": {"retry_after": server.retry_after}}).encode()
+        else:
+            status = 200
+            body = json.dumps({"ok": True, "result": _result_for(method, server, params)}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = _handle
+    do_POST = _handle
+
+
+class FakeTelegram(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, rate_429=0.0, retry_after=1,
+                 throttle_methods=("sendMessage",), seed=None):
+        super().__init__((host, port), Handler)
+        self.stats = Stats()
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.throttle_methods = set(throttle_methods)
+        self.rnd = random.Random(seed)
+        self.message_id = 0
+        self.left = set()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Local fake Telegram Bot API server")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    ap.add_argument("--jitter", type=float, default=0.0, help="extra random delay in [0, jitter] seconds")
+    ap.add_argument("--rate-429", type=float, default=0.0, help="probability of answering 429 (sendMessage)")
+    ap.add_argument("--retry-after", type=int, default=1, help="retry_after sent with 429s")
+    args = ap.parse_args()
+    srv = FakeTelegram(args.host, args.port, args.latency, args.jitter, args.rate_429, args.retry_after)
+    print(f"fake Telegram on {srv.base_url}")
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
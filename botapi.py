@@ -0,0 +1,121 @@
+import os, time, requests
+from requests.adapters import HTTPAdapter
+
+aiohttp = None  # אופציונלי – נטען בעצלות רק ל-AsyncBotAPI (ה-import שלו ~200ms בעליית worker)
+
+
+def load_aiohttp():
+    """מחזיר את המודול aiohttp, או None אם אינו מותקן."""
+    global aiohttp
+    if aiohttp is None:
+        try:
+            import aiohttp as module
+        except ImportError:
+            return None
+        aiohttp = module
+    return aiohttp
+
+# ===== קונפיג חיבורים ל-Bot API =====
+API_BASE = os.getenv("TG_API_BASE", "https://api.telegram.org")  # לבנצ'מרק: http://127.0.0.1:8081
+POOL_SIZE = int(os.getenv("TG_POOL_SIZE", "20"))                  # חיבורי keep-alive פתוחים לכל היותר
+CONNECT_TIMEOUT = float(os.getenv("TG_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("TG_READ_TIMEOUT", "20"))
+
+
+class BotAPI:
+    """
+    קליינט סינכרוני ל-Bot API מעל requests.Session אחד משותף:
+    חיבורי TLS נשמרים פתוחים (keep-alive) ונלקחים מה-pool במקום handshake לכל קריאה.
+    מחזיר את ה-Response כמו שהוא, כדי שהקוראים יחליטו מה לעשות עם status/text.
+    observer (אופציונלי) נקרא אחרי כל קריאה עם (method, status, seconds) – status הוא
+    קוד ה-HTTP, או "error" כשהבקשה עצמה נכשלה (timeout/חיבור).
+    """
+
+    def __init__(self, token: str, base: str = API_BASE, pool_size: int = POOL_SIZE,
+                 connect_timeout: float = CONNECT_TIMEOUT, read_timeout: float = READ_TIMEOUT,
+                 observer=None):
+        self.url = f"{base.rstrip('/')}/bot{token}"
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.observer = observer
+        self.session = requests.Session()
+        # pool_block=False: בעומס חריג נפתחים חיבורים נוספים אבל רק pool_size נשמרים לשימוש חוזר
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=0, pool_block=False)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _timeout(self, timeout):
+        return (self.connect_timeout, timeout if timeout is not None else self.read_timeout)
+
+    def _call(self, http_method: str, method: str, **kw):
+        if self.observer is None:
+            return self.session.request(http_method, f"{self.url}/{method}", **kw)
+        started = time.perf_counter()
+        status = "error"
+        try:
+            rsp = self.session.request(http_method, f"{self.url}/{method}", **kw)
+            status = rsp.status_code
+            return rsp
+        finally:
+            self.observer(method, status, time.perf_counter() - started)
+
+    def post(self, method: str, payload: dict | None = None, *, files=None, timeout: float | None = None):
+        if files:
+            # multipart (למשל sendDocument) – השדות נשלחים כ-form data
+            return self._call("POST", method, data=payload or {}, files=files, timeout=self._timeout(timeout))
+        return self._call("POST", method, json=payload or {}, timeout=self._timeout(timeout))
+
+    def get(self, method: str, params: dict | None = None, *, timeout: float | None = None):
+        return self._call("GET", method, params=params or {}, timeout=self._timeout(timeout))
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncBotAPI:
+    """
+    אותו ממשק מעל aiohttp (לעבודה בתוך event loop). post/get מחזירים (status, json).
+    ה-ClientSession נוצר בעצלות בתוך ה-loop הרץ, ו-TCPConnector מגביל ל-pool_size חיבורים.
+    """
+
+    def __init__(self, token: str, base: str = API_BASE, pool_size: int = POOL_SIZE,
+                 connect_timeout: float = CONNECT_TIMEOUT, read_timeout: float = READ_TIMEOUT):
+        if load_aiohttp() is None:
+            raise RuntimeError("AsyncBotAPI requires aiohttp (pip install aiohttp).")
+        self.url = f"{base.rstrip('/')}/bot{token}"
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            timeout = aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    async def _read(self, rsp):
+        try:
+            data = await rsp.json(content_type=None)
+        except Exception:
+            data = {"ok": False, "description": await rsp.text()}
+        return rsp.status, data
+
+    async def post(self, method: str, payload: dict | None = None):
+        async with self._get_session().post(f"{self.url}/{method}", json=payload or {}) as rsp:
+            return await self._read(rsp)
+
+    async def get(self, method: str, params: dict | None = None):
+        async with self._get_session().get(f"{self.url}/{method}", params=params or {}) as rsp:
+            return await self._read(rsp)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
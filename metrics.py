@@ -0,0 +1,172 @@
+import bisect, math, threading
+
+# גבולות ברירת מחדל (שניות) – מ-1ms ועד 10s, מתאים גם לפקודות וגם לקריאות רשת
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Registry:
+    """רשימת המטריקות שנחשפות ב-/metrics. render מחזיר את פורמט הטקסט של Prometheus."""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics)
+        for m in metrics:
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            try:
+                lines.extend(m.render())
+            except Exception as e:  # gauge עם callback שנכשל לא מפיל את כל ה-scrape
+                lines.append(f"# {m.name} collect failed: {e!r}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def _fmt_labels(names, values, extra=()) -> str:
+    pairs = [(n, v) for n, v in zip(names, values)] + list(extra)
+    if not pairs:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return "{" + ",".join(f'{n}="{esc(v)}"' for n, v in pairs) + "}"
+
+
+def _fmt_value(v) -> str:
+    if v == math.inf:
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Counter:
+    """מונה מצטבר לכל צירוף labels. inc הוא חיבור אחד תחת נעילה – זול מספיק ל-hot path."""
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def render(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_fmt_labels(self.labels, k)} {_fmt_value(v)}" for k, v in items]
+
+
+class Gauge:
+    """
+    ערך נקודתי. אפשר לעדכן עם set, או לתת fn שנקראת רק בזמן scrape ומחזירה מספר
+    או dict של labels tuple -> ערך (למשל מצב תור או גודל journal) – אפס עלות ב-hot path.
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels=(), fn=None, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.fn = fn
+        self._values = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def set(self, value: float, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def render(self):
+        if self.fn is not None:
+            values = self.fn()
+            items = sorted(values.items()) if isinstance(values, dict) else [((), values)]
+        else:
+            with self._lock:
+                items = sorted(self._values.items())
+        return [f"{self.name}{_fmt_labels(self.labels, k)} {_fmt_value(v)}" for k, v in items]
+
+
+class Histogram:
+    """
+    היסטוגרמה מצטברת בזיכרון התהליך (בסגנון Prometheus): לכל צירוף labels נשמרים
+    מונים לכל bucket, סכום ומספר תצפיות. observe הוא O(log buckets) תחת נעילה אחת.
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # labels tuple -> [counts per bucket (+Inf בסוף), sum, count]
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def observe(self, value: float, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(labels)
+            if s is None:
+                s = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            s[0][i] += 1
+            s[1] += value
+            s[2] += 1
+
+    def _items(self):
+        with self._lock:
+            return sorted((k, list(v[0]), v[1], v[2]) for k, v in self._series.items())
+
+    def render(self):
+        lines = []
+        for labels, counts, total, n in self._items():
+            acc = 0
+            for bound, c in zip(self.buckets + (math.inf,), counts):
+                acc += c
+                le = _fmt_labels(self.labels, labels, [("le", _fmt_value(bound))])
+                lines.append(f"{self.name}_bucket{le} {acc}")
+            lines.append(f"{self.name}_sum{_fmt_labels(self.labels, labels)} {_fmt_value(total)}")
+            lines.append(f"{self.name}_count{_fmt_labels(self.labels, labels)} {n}")
+        return lines
+
+    def snapshot(self) -> dict:
+        # למסך ה-stats: count/avg ואחוזון 50/95/99 משוערך לפי גבול ה-bucket העליון
+        out = {}
+        for labels, counts, total, n in self._items():
+            key = ",".join(str(x) for x in labels) or self.name
+            row = {"count": n, "avg_ms": round(total / n * 1000, 2) if n else 0.0}
+            for q in (0.5, 0.95, 0.99):
+                row[f"p{int(q * 100)}_ms"] = self._quantile(counts, n, q)
+            out[key] = row
+        return out
+
+    def _quantile(self, counts, n, q):
+        if not n:
+            return 0.0
+        rank, acc = q * n, 0
+        for i, c in enumerate(counts):
+            acc += c
+            if acc >= rank:
+                if i < len(self.buckets):
+                    return round(self.buckets[i] * 1000, 2)
+                break
+        return None  # מעל ה-bucket העליון